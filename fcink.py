@@ -72,7 +72,10 @@
 
 # importy
 # import pdb
-import sys, os, re, math
+import sys, os, re, math, types, heapq, bisect, time, hashlib, struct
+import concurrent.futures, array, queue, multiprocessing, collections
+from multiprocessing import shared_memory
+import xml.etree.ElementTree as etree
 import tkinter as tk
 import tkinter.filedialog as tkfdia
 import tkinter.colorchooser as tkcolc
@@ -80,7 +83,16 @@ sys.path.append(os.path.join('..', 'lib'))
 import base3 as base
 from base3 import Date, String
 import ioc, mathfx
+try:
+ import numpy
+except ImportError:
+ numpy = None # volitelné - bez NumPy se počítá bod po bodu
+try:
+ import resource
+except ImportError:
+ resource = None # jen POSIX - bez něj hlídaný výpočet nemá limit paměti
 log = None
+mgr = None
 
 DATAF_EXT = 'fxml'
 
@@ -88,6 +100,19 @@ DATAF_EXT = 'fxml'
 class FunctionError(RuntimeError):
  pass
 
+# chyba v zápisu předpisu (ExprParser), pos - pozice v zápisu (None, pokud ji nelze určit)
+class ExpressionError(FunctionError):
+ def __init__(self, message, pos=None):
+  if pos is None:
+   FunctionError.__init__(self, message)
+  else:
+   FunctionError.__init__(self, '{0} (pozice {1})'.format(message, pos + 1))
+  self.pos = pos
+
+# výpočet funkce překročil limit času nebo paměti (EvaluationGuard)
+class EvaluationGuardError(FunctionError):
+ pass
+
 class BaseClass:
  name = 'BASE'
  
@@ -158,6 +183,8 @@ class Processor(BaseClass):
   self.defFileName = conf.get('out', 'default-filename') + '.' + DATAF_EXT
  
  def cleanup(self):
+  if mgr:
+   mgr.shutdown()
   self.log('Exitting')
  
  def exit(self):
@@ -175,18 +202,24 @@ class FunctionManager(ComputingClass):
   self.resetFunctionOrds()
   self.functions = {}
   self.selected = None
+  self.evaluators = EvaluatorCache(conf.get('gridpar', 'evaluator-cache'))
+  self.memoScale = None
+  self.sharingSuspended = False
+  self.sampleCache = None
+  if conf.get('gridpar', 'sample-cache'):
+   self.sampleCache = SampleCache(conf.get('path', 'sample-cache'), conf.get('gridpar', 'sample-cache-size'))
  
  def createFunction(self, expr):
   fid = self.functionId
   self.functions[fid] = Function(fid, expr, number=self.functionOrd)
-  self.countFunction(fid)
   self.functionId += 1
   self.functionOrd += 1
+  self.shareSubtrees()
   return fid
  
  def editFunction(self, fid, expr):
   self.functions[fid].edit(expr)
-  self.countFunction(fid)
+  self.shareSubtrees()
  
  def loadFunction(self, fid, number, exprSrc, exprFin):
   self.functions[fid] = Function(fid, exprSrc, exprFin=exprFin, number=number)
@@ -194,7 +227,27 @@ class FunctionManager(ComputingClass):
    self.functionId = fid + 1
   if number >= self.functionOrd:
    self.functionOrd = number + 1
-  self.countFunction(fid)
+  self.shareSubtrees()
+ 
+ # Při hromadné změně (načtení dokumentu) se společné podvýrazy hledají až jednou na konci
+ def suspendSharing(self):
+  self.sharingSuspended = True
+ 
+ def resumeSharing(self):
+  self.sharingSuspended = False
+  self.shareSubtrees()
+ 
+ # Najde drahé podvýrazy jen s x, které má víc funkcí (stromy jsou n-tice, takže se dají
+ # rovnou počítat ve slovníku), a funkce si je pak pamatují ve společných memos.
+ def shareSubtrees(self):
+  if self.sharingSuspended:
+   return
+  counts = collections.Counter()
+  for func in self.functions.values():
+   counts.update(func.getShareable())
+  shared = frozenset(subtree for subtree, count in counts.items() if count > 1)
+  for func in self.functions.values():
+   func.setShared(shared)
  
  def resetFunctionOrds(self):
   self.functionOrd = 1
@@ -216,6 +269,7 @@ class FunctionManager(ComputingClass):
    self.selected = None
   if fid is not None:
    del self.functions[fid]
+   self.shareSubtrees()
 
  def thickerFunction(self, fid):
   self.getFunction(fid).setLineWidth(conf.get('gridpar', 'highlight-function-linewidth'))
@@ -228,12 +282,23 @@ class FunctionManager(ComputingClass):
    fid = self.getSelectedFID()
   self.getFunction(fid).setColor(color)
  
- def countFunctions(self):
+ # Přepočítá funkce, které to potřebují (změnou mřížky nebo předpisu), pro pohled view.
+ # S pool se nové vzorky počítají na pozadí (viz EvaluationPool).
+ def countFunctions(self, view, pool=None):
+  if view.xUnitPx != self.memoScale: # jiná mřížka x - zapamatované hodnoty už nepomohou
+   self.evaluators.clearMemos()
+   self.memoScale = view.xUnitPx
+  for func in list(self.functions.values()):
+   if func.isDirty():
+    try:
+     func.count(view, pool)
+    except FunctionError:
+     func.deleteSelf()
+     raise
+ 
+ def invalidateFunctions(self, stage):
   for func in self.functions.values():
-   func.count()
-   
- def countFunction(self, fid):
-  self.getFunction(fid).count()
+   func.invalidate(stage)
 
  def getFunction(self, fid):
   try:
@@ -275,7 +340,12 @@ class Function(ComputingClass):
   if exprFin is None:
    self.setExpr(exprSrc, *Function.prepareExpr(exprSrc))
   else:
-   self.setExpr(exprSrc, exprFin, Function.findPars(exprFin))
+   # ze souboru - předpis se rozebere znovu, uložený kód jen pro zápisy, které nový rozbor nezná
+   try:
+    prepared = Function.prepareExpr(exprSrc)
+   except ExpressionError:
+    prepared = (exprFin, Function.findPars(exprFin))
+   self.setExpr(exprSrc, *prepared)
 
  def setBasic(self, fid, number):
   self.fid = fid
@@ -285,12 +355,23 @@ class Function(ComputingClass):
   self.pars = []
   self.parametric = False
   self.parValues = []
+  self.stage = 0
+  self.generation = 0
+  self.view = None
+  self.sampleCost = None # naměřená cena jednoho vzorku (s)
+  self.reduced = False # vzorky jsou spočteny se sníženým rozpočtem
+  self.sampleYUnitPx = None # měřítko y, pro které platí tolerance vzorků
+  self.refining = False # příští plán vzorkování s plným rozpočtem
+  self.refinePending = False # dopočet plného rozpočtu běží
+  self.failed = None # důvod, proč hlídaný výpočet funkci zastavil
 
  def edit(self, exprSrc):
   exprSrc = exprSrc.replace('^', '**')
   self.setExpr(exprSrc, *Function.prepareExpr(exprSrc))
  
- def setExpr(self, exprSrc, exprFin, pars):
+ def setExpr(self, exprSrc, exprFin, pars, tree=None):
+  self.failed = None
+  self.tree = tree
   self.exprFin = exprFin
   self.pars = pars
   if self.pars:
@@ -301,23 +382,56 @@ class Function(ComputingClass):
   else:
    self.exprSrc = 'y = ' + exprSrc
   self.name += '-' + self.exprSrc
-  message = Function.exprErrorTest(self.exprFin, self.pars)
-  if message:
+  self.shared = frozenset()
+  if tree is not None:
+   try:
+    self.canonical = ExprOptimizer.prepare(tree)
+    self.shareable = ExprOptimizer.getShareable(self.canonical[0])
+   except RecursionError:
+    raise ExpressionError(ExprParser.TOO_DEEP)
+  else:
+   self.canonical = self.exprFin
+   self.shareable = frozenset()
+  self.compile()
+  self.invalidateSamples()
+  self.invalidate()
+ 
+ # Hluboko vnořený strom může přetéct zásobník optimalizace i překladače Pythonu
+ # (RecursionError, MemoryError, SyntaxError - příliš mnoho vnořených závorek).
+ def compile(self):
+  try:
+   if self.tree is not None:
+    self.code = ExprCompiler.generateBinder(self.tree, self.pars, self.shared)
+   else:
+    self.code = ExprCompiler.getBinder(self.exprFin, self.pars)
+   self.evaluator = fman.evaluators.get(self.code, self.pars, ArrayBackend.isAvailable())
+  except (RecursionError, MemoryError, SyntaxError) as message:
+   if self.tree is None:
+    raise FunctionError(message)
+   raise ExpressionError(ExprParser.TOO_DEEP)
+  except Exception as message: # chybný kód (jen u dříve uloženého exprFin)
    raise FunctionError(message)
-  self.function = Function.evalFunction(self.exprFin, self.pars)
+ 
+ # Podvýrazy jen s x, které má i jiná funkce (FunctionManager.shareSubtrees) - sample si je
+ # pamatuje ve společných memos, takže se na stejné mřížce x počítají jen jednou.
+ # Hodnoty funkce se nemění, vzorky zůstávají platné.
+ def setShared(self, shared):
+  shared = frozenset(shared & self.shareable)
+  if shared != self.shared:
+   self.shared = shared
+   self.compile()
+ 
+ def getShareable(self):
+  return self.shareable
  
   
  # Vrací hodnotu funkce v daném bodě, pro nedefinovanou hodnotu a imag. číslo None.
  def getValue(self, x, **par):
-  try:
-   res = self.function(x, **par)
-   if type(res) is type(1j): return None
-   else: return res
-  except (ArithmeticError, ValueError, TypeError):
-   return None
-  except Exception as message:
-   self.deleteSelf()
-   raise FunctionError(message)
+  return self.evaluator.getValue(x, **par)
+ 
+ # Vrací hodnoty funkce pro celý seznam bodů.
+ def getValues(self, xs, **par):
+  return self.evaluator.getValues(xs, **par)
  
  # Vrací ID funkce.
  def getFID(self):
@@ -363,41 +477,253 @@ class Function(ComputingClass):
  
  def setParValue(self, par, value):
   self.parValues[self.pars.index(par)] = value
-  self.count()
+  self.failed = None
+  # stávající vzorky zůstávají zobrazené, dokud je nenahradí nové (applySamples, 'all')
+  self.generation += 1
+  self.sampleKey = None
+  self.invalidate()
   mgr.replotFunction(self.fid)
  
- # Podle hranic pole vytvoří uspořádané dvojice výsledků - hodnot
- def count(self):
-  self.reset()
-  newDiff = 0
+ # Podle hranic pohledu vytvoří uspořádané dvojice výsledků - hodnot
+ # (jen do té míry, jakou vyžaduje poslední změna - viz PlotComputer.getChangeStage).
+ # S pool se chybějící vzorky jen zadají k výpočtu na pozadí a zatím se vykreslí ty stávající.
+ def count(self, view, pool=None):
+  self.reset(view)
+  if self.failed is not None:
+   self.pointList = []
+   self.stage = 0
+   return
+  if self.stage >= PlotComputer.STAGE_SAMPLE:
+   job = self.planSamples()
+   if job is not None:
+    if job.isCached():
+     self.applySamples(job)
+    elif pool is None:
+     self.applySamples(job.run())
+    else:
+     pool.submit(job)
+  self.project()
+  self.stage = 0
+ 
+ # Označuje funkci k přepočtu (při nejbližším vykreslení) - nové vzorky nebo jen převod na pixely.
+ def invalidate(self, stage=None):
+  if stage is None:
+   stage = PlotComputer.STAGE_SAMPLE
+  self.stage = max(self.stage, stage)
+ 
+ def isDirty(self):
+  return self.stage >= PlotComputer.STAGE_PROJECT
+ 
+ # Určuje, co je třeba dopočítat, aby uložené vzorky (v číselných souřadnicích) pokryly
+ # zobrazený rozsah i s přesahem. Při posunu se počítá jen nově odkrytý kus, při změně
+ # měřítka x vše znovu (změna měřítka y vzorky nemění - po zvětšení y se dopočítají odloženě,
+ # viz needsRefine). Každé plánování zneplatní dosud nedokončené úlohy (generation).
+ def planSamples(self):
+  self.generation += 1
+  self.budget = self.getBudget()
+  self.refinePending = self.refining
+  self.refining = False
+  key = self.view.xUnitPx
+  overscan = self.range * conf.get('gridpar', 'sample-overscan')
+  parDict = base.mapToDict(self.pars, self.parValues)
+  job = SampleJob(self.fid, self.generation, key, 2 * overscan, (self.code, self.pars, parDict, ArrayBackend.isAvailable()),
+   self.budget[0] < self.steps)
+  job.yUnitPx = self.view.yUnitPx
+  if key != self.sampleKey or not self.sampleX or self.highBorder < self.sampleX[0] or self.lowBorder > self.sampleX[-1]:
+   job.addPart('all', self.lowBorder - overscan, self.highBorder + overscan, self.getSampler)
+  else:
+   if self.lowBorder < self.sampleX[0]:
+    job.addPart('left', self.lowBorder - overscan, self.sampleX[0], self.getSampler)
+   if self.highBorder > self.sampleX[-1]:
+    job.addPart('right', self.sampleX[-1], self.highBorder + overscan, self.getSampler)
+  if job.isEmpty():
+   return None
+  if fman.sampleCache is not None:
+   job.cacheKeys = [self.getCacheKey(low, high) for side, low, high, sampler in job.getParts()]
+   results = fman.sampleCache.loadAll(job.cacheKeys)
+   if results is not None:
+    job.setCached(results)
+  return job
+ 
+ # Vkládá spočtené vzorky, pokud úloha mezitím nezastarala.
+ def applySamples(self, job):
+  if job.generation != self.generation:
+   return False
+  if job.cacheKeys and not job.isCached() and not job.isReduced() and \
+   job.elapsed * 1000 >= conf.get('gridpar', 'sample-cache-min-time'):
+   fman.sampleCache.storeAll(job.cacheKeys, job.getResults())
+  count = 0
+  for side, (xs, ys) in job.getResults():
+   count += len(xs)
+   if side == 'all':
+    self.sampleX, self.sampleY = xs, ys
+    self.reduced = job.isReduced()
+    self.sampleYUnitPx = job.yUnitPx
+    self.refinePending = False
+   elif side == 'left':
+    self.sampleX[:0] = xs[:-1]
+    self.sampleY[:0] = ys[:-1]
+   else:
+    self.sampleX.extend(xs[1:])
+    self.sampleY.extend(ys[1:])
+   if side != 'all':
+    self.reduced = self.reduced or job.isReduced()
+  if count and not job.isCached():
+   cost = job.elapsed / count
+   self.sampleCost = cost if self.sampleCost is None else (self.sampleCost + cost) / 2
+  self.sampleKey = job.key
+  self.trimSamples(job.keep)
+  self.invalidate(PlotComputer.STAGE_PROJECT)
+  return True
+ 
+ # Vzorkovač intervalu, počet vzorků úměrný jeho podílu na zobrazeném rozsahu.
+ # Hodnoty parametrů i pohledu si bere hned, takže může počítat mimo hlavní vlákno.
+ def getSampler(self, low, high, cancelled=None):
   parDict = base.mapToDict(self.pars, self.parValues)
-  for i in range(self.steps + 1):
+  evaluator = self.evaluator # úprava předpisu mezitím vyměňuje evaluator
+  steps, timeLimit = self.budget
+  return AdaptiveSampler((lambda xs: evaluator.getValues(xs, **parDict)), *self.getSamplerSettings(low, high, steps),
+   timeLimit, cancelled)
+ 
+ def getSamplerSettings(self, low, high, steps):
+  part = (high - low) / self.range
+  return (self.view.xUnitPx, self.view.yUnitPx, conf.get('gridpar', 'adaptive-tolerance'), conf.get('gridpar', 'adaptive-min-width'),
+   max(1, int(conf.get('gridpar', 'adaptive-start-steps') * part)), max(2, int(steps * part)))
+ 
+ # Klíč intervalu v diskové cache vzorků - s plným rozpočtem, ukládají se jen úplné výsledky.
+ # Předpis je v klíči jako upravený strom (ExprOptimizer.prepare), ne kód - ten závisí i na
+ # podvýrazech sdílených s ostatními funkcemi (shared).
+ def getCacheKey(self, low, high):
+  return SampleCache.getKey(self.canonical, self.parValues, low, high, self.getSamplerSettings(low, high, self.steps))
+ 
+ # Rozpočet vzorkování (počet vzorků na celý rozsah, časový limit v s). Podle naměřené ceny
+ # vzorku se počet sníží tak, aby se výpočet vešel do frame-budget; plný rozpočet bez limitu
+ # dostane až odložený dopočet (refine).
+ def getBudget(self):
+  if self.refining:
+   return self.steps, None
+  timeLimit = conf.get('gridpar', 'frame-budget') / 1000
+  if self.sampleCost is None or self.sampleCost * self.steps <= timeLimit:
+   return self.steps, timeLimit
+  return min(self.steps, max(conf.get('gridpar', 'min-compute-steps'), int(timeLimit / self.sampleCost))), timeLimit
+ 
+ def isReduced(self):
+  return self.reduced
+ 
+ # Hlídaný výpočet funkci zastavil - dál se nepočítá, dokud se nezmění předpis nebo parametr
+ def fail(self, reason):
+  self.failed = reason
+  self.reduced = False
+  self.invalidateSamples()
+  self.invalidate()
+ 
+ def isFailed(self):
+  return self.failed is not None
+ 
+ # Při hlídaném výpočtu se v hlavním procesu nic nepočítá (odečet a náhled jen ze vzorků)
+ def isGuarded(self):
+  return bool(conf.get('gridpar', 'evaluation-guard'))
+ 
+ # Zobrazena se sníženým rozlišením a dopočet ještě nezačal
+ def needsRefine(self):
+  return (self.reduced or self.isCoarse()) and not self.refining and not self.refinePending
+ 
+ # Osa y se od vzorkování zvětšila - odchylka mezi vzorky už v pixelech nemusí být pod adaptive-tolerance
+ def isCoarse(self):
+  return self.sampleYUnitPx is not None and self.view is not None and self.view.yUnitPx > self.sampleYUnitPx
+ 
+ # Odložený dopočet - celý rozsah znovu s plným rozpočtem
+ def refine(self):
+  self.refining = True
+  self.sampleKey = None
+  self.invalidate()
+ 
+ # Zahazuje vzorky vzdálené od zobrazeného rozsahu víc než keep.
+ def trimSamples(self, keep):
+  start = bisect.bisect_left(self.sampleX, self.lowBorder - keep)
+  end = bisect.bisect_right(self.sampleX, self.highBorder + keep)
+  if start > 0 or end < len(self.sampleX):
+   self.sampleX = self.sampleX[start:end]
+   self.sampleY = self.sampleY[start:end]
+ 
+ def invalidateSamples(self):
+  self.generation += 1
+  self.sampleKey = None
+  self.sampleX = []
+  self.sampleY = []
+  self.sampleYUnitPx = None
+ 
+ # Převádí vzorky v zobrazeném rozsahu na úseky čar v pixelech.
+ def project(self):
+  start = max(0, bisect.bisect_right(self.sampleX, self.lowBorder) - 1)
+  end = bisect.bisect_left(self.sampleX, self.highBorder) + 1
+  self.pointList = self.segment(self.sampleX[start:end], self.sampleY[start:end], self.view)
+ 
+ # Rozděluje vzorky na úseky čar v pixelech (posunuté o xOff, yOff) - u nedefinovaných
+ # hodnot a skoků se čára přerušuje.
+ def segment(self, xs, ys, view, xOff=0, yOff=0):
+  pointList = [[]]
+  newDiff = 0
+  lastX = None
+  lastY = None
+  for newX, newY in zip(xs, ys):
    oldDiff = newDiff
-   newX = self.lowBorder + (self.resolution * i)
-   newY = self.getValue(newX, **parDict)
-   if self.y and self.y[-1] is not None and newY is not None:
-    newDiff = abs(newY - self.y[-1])
+   if lastY is not None and newY is not None:
+    # rozdíl přepočtený na krok pravidelné mřížky (vzorky nejsou rovnoměrně)
+    newDiff = abs(newY - lastY) * self.resolution / (newX - lastX)
    if abs(newDiff - oldDiff) > self.yRange:
-    self.x.append(newX - self.resolution / 2)
-    self.y.append(None)
-    self.pointList.append([]) # nedefinovana hodnota - dalsi usek cary
-   self.x.append(newX)
-   self.y.append(newY)
+    pointList.append([]) # skok - dalsi usek cary
+   lastX = newX
+   lastY = newY
    if newY is None:
-    self.pointList.append([])
+    pointList.append([]) # nedefinovana hodnota - dalsi usek cary
    else:
-    self.pointList[-1].append(comp.getXPx(newX))
-    self.pointList[-1].append(comp.getYPx(newY))
- 
- def reset(self):
-  self.x = []
-  self.y = []
-  self.pointList = [[]]
-  self.lowBorder = comp.getXMinus()
-  self.highBorder = comp.getXPlus()
+    pointList[-1].append(view.getXPx(newX) + xOff)
+    pointList[-1].append(view.getYPx(newY) + yOff)
+  pointList = LineClipper.forView(view).clipAll(pointList)
+  if conf.get('gridpar', 'polyline-reduction'):
+   pointList = [PolylineReducer.reduce(points) for points in pointList]
+  return pointList
+ 
+ # Hodnota v x pro odečet pod kurzorem - lineárně mezi uloženými vzorky, pokud jsou kolem x
+ # dost husté (hover-sample-gap px), jinak přesně pro jeden bod.
+ def getValueAt(self, x):
+  i = bisect.bisect_left(self.sampleX, x)
+  if 0 < i < len(self.sampleX):
+   x1, x2 = self.sampleX[i-1], self.sampleX[i]
+   y1, y2 = self.sampleY[i-1], self.sampleY[i]
+   if y1 is not None and y2 is not None and ((x2 - x1) * self.view.xUnitPx <= conf.get('gridpar', 'hover-sample-gap') or self.isGuarded()):
+    return y1 + (y2 - y1) * (x - x1) / (x2 - x1)
+  if self.isGuarded() or self.isFailed():
+   return None
+  return self.getValue(x, **base.mapToDict(self.pars, self.parValues))
+ 
+ # Náhled úseku <low, high> při živém posunu o (xOff, yOff) pixelů. Bere uložené vzorky,
+ # a pokud nestačí, spočte úsek jen zhruba (preview-steps na celou šířku) a neukládá ho.
+ def getPreviewPoints(self, low, high, view, xOff, yOff):
+  if self.isGuarded() or self.isFailed():
+   if not self.sampleX: return []
+   low = max(low, self.sampleX[0])
+   high = min(high, self.sampleX[-1])
+   if low >= high: return []
+  if self.sampleX and self.sampleX[0] <= low and self.sampleX[-1] >= high:
+   start = max(0, bisect.bisect_right(self.sampleX, low) - 1)
+   end = bisect.bisect_left(self.sampleX, high) + 1
+   xs = self.sampleX[start:end]
+   ys = self.sampleY[start:end]
+  else:
+   steps = max(2, int(conf.get('gridpar', 'preview-steps') * (high - low) / self.range))
+   xs = [low + (high - low) * i / steps for i in range(steps + 1)]
+   ys = self.getValues(xs, **base.mapToDict(self.pars, self.parValues))
+  return self.segment(xs, ys, view, xOff, yOff)
+ 
+ def reset(self, view):
+  self.view = view
+  self.lowBorder = view.xMinus
+  self.highBorder = view.xPlus
   self.range = self.highBorder - self.lowBorder
   self.resolution = self.range / self.steps
-  self.yRange = comp.getYRange()
+  self.yRange = view.yRange
 
  def getPoints(self):
   return self.pointList
@@ -406,31 +732,7 @@ class Function(ComputingClass):
   fman.deleteFunction(self.getFID())
  
  
- # Test korektnosti předpisu funkce.
- @staticmethod
- def exprErrorTest(exprFin, pars):
-  try:
-   function = Function.evalFunction(exprFin, pars)
-  except Exception as message:
-   return message
-  else:
-   return False
-
- # Vrací z předpisu objekt funkce.
- @staticmethod
- def evalFunction(exprFin, pars):
-  parStr = Function.getParStr(pars)
-  return eval('lambda {par}: {ex}'.format(par=parStr, ex=exprFin))
- 
- # Sestavuje řetězec ze seznamu parametrů.
- @staticmethod
- def getParStr(pars):
-  parStr = 'x'
-  for par in pars:
-   parStr += (', ' + par)
-  return parStr
-
- # Hledá v předpisu parametry.
+ # Hledá parametry v (dříve uloženém) kódu předpisu.
  @staticmethod
  def findPars(exprFin):
   pars = []
@@ -439,80 +741,1360 @@ class Function(ComputingClass):
     pars.append(par)
   return pars
 
- # Připravuje předpis pro počítačový výpočet.
+ # Připravuje předpis pro počítačový výpočet - strom výrazu (ExprParser) a z něj kód v Pythonu.
  @staticmethod
  def prepareExpr(expr):
-  expr = ''.join(expr.split(' ')) # bez mezer
-  for i in range(len(Function.EXPR_SUBPATT)):
-   expr = expr.replace(Function.EXPR_SUBPATT[i], Function.EXPR_SUBSUBST[i])
-  for i in range(len(Function.EXPR_REGPATT)):
-   while re.search(Function.EXPR_REGPATT[i], expr):
-    expr = re.sub(Function.EXPR_REGPATT[i], Function.EXPR_REGFUNC[i], expr)
-    break
-  print(expr)
-  return expr, Function.findPars(expr)
+  tree = ExprParser(expr).parse()
+  try:
+   code = ExprCompiler.generate(tree)
+  except RecursionError:
+   raise ExpressionError(ExprParser.TOO_DEEP)
+  return code, ExprParser.getPars(tree), tree
+ 
+ PARS = ['a', 'b', 'c', 'd']
+
+
+# Rozbor zápisu funkce (syntaxe fcink) na strom výrazu. Lexer projde zápis jednou (jeden
+# regulární výraz), parser je rekurzivní sestup; chyby hlásí s pozicí v zápisu.
+# Syntaxe: + - * / % ^ (i **), desetinná čárka, |x| (abs), [x] (int), implicitní násobení
+# (2x, ax, 2(x+1), x|x|...), funkce se závorkami i bez nich (sinx = sin(x)), log2(x) a root3(x)
+# se základem, proměnná x, parametry a-d, konstanty pi a e.
+# Uzly stromu jsou n-tice (druh, ...), takže se dají porovnávat a hashovat:
+#  ('num', číslo), ('var', jméno), ('const', jméno), ('neg', a), ('add'|'sub'|'mul'|'div'|'mod'|'pow', a, b),
+#  ('call', funkce, a), ('log', a, základ).
+class ExprParser(ComputingClass):
+ name = 'PARSE'
+ TOO_DEEP = 'předpis je příliš hluboko vnořený'
+ # zápis funkce -> funkce ve stromu (sqrt a root se převádějí na mocninu)
+ FUNCTIONS = {'sin' : 'sin', 'cos' : 'cos', 'tan' : 'tan', 'tg' : 'tan', 'cot' : 'cot', 'cotg' : 'cot', 'cotan' : 'cot',
+  'arcsin' : 'asin', 'arccos' : 'acos', 'arctg' : 'atan', 'arctan' : 'atan', 'exp' : 'exp', 'ln' : 'ln',
+  'abs' : 'abs', 'sgn' : 'sgn', 'log' : 'log', 'root' : 'root', 'sqrt' : 'sqrt'}
+ CONSTANTS = ('pi', 'e')
+ VARS = ('x', 'a', 'b', 'c', 'd')
+ TOKEN_RE = re.compile(r'\s*(?:(?P<num>\d+(?:[.,]\d*)?|[.,]\d+)|(?P<name>[a-z]+)|(?P<op>\*\*|[-+*/%^()|\[\]]))')
+ # názvy v souvislém úseku písmen (xsin, pix...) - nejdelší shoda má přednost
+ NAME_RE = re.compile('|'.join(sorted(list(FUNCTIONS) + list(CONSTANTS) + list(VARS), key=len, reverse=True)))
+ 
+ def __init__(self, text):
+  self.text = text.lower()
+  head = re.match(r'\s*y\s*=', self.text) # předpis může začínat y =
+  self.tokens = self.tokenize(head.end() if head else 0)
+  self.index = 0
+  self.absDepth = 0
+ 
+ # Vrací seznam tokenů (druh, hodnota, pozice), druhy num, var, const, func, op a end.
+ def tokenize(self, pos):
+  tokens = []
+  end = len(self.text.rstrip())
+  while pos < end:
+   match = ExprParser.TOKEN_RE.match(self.text, pos)
+   if match is None:
+    raise ExpressionError('neznámý znak {0!r}'.format(self.text[pos:].lstrip()[0]), pos + len(self.text[pos:]) - len(self.text[pos:].lstrip()))
+   start = match.start(match.lastgroup)
+   if match.lastgroup == 'num':
+    tokens.append(('num', float(match.group('num').replace(',', '.')), start))
+   elif match.lastgroup == 'op':
+    op = match.group('op')
+    tokens.append(('op', '^' if op == '**' else op, start))
+   else:
+    tokens.extend(self.splitNames(match.group('name'), start))
+   pos = match.end()
+  tokens.append(('end', None, end))
+  return tokens
+ 
+ def splitNames(self, letters, start):
+  tokens = []
+  pos = 0
+  while pos < len(letters):
+   match = ExprParser.NAME_RE.match(letters, pos)
+   if match is None:
+    raise ExpressionError('neznámý název {0!r}'.format(letters[pos:]), start + pos)
+   name = match.group(0)
+   if name in ExprParser.FUNCTIONS:
+    tokens.append(('func', ExprParser.FUNCTIONS[name], start + pos))
+   elif name in ExprParser.CONSTANTS:
+    tokens.append(('const', name, start + pos))
+   else:
+    tokens.append(('var', name, start + pos))
+   pos = match.end()
+  return tokens
+ 
+ def parse(self):
+  try:
+   tree = self.parseSum()
+  except RecursionError: # rekurzivní sestup - hloubka vnoření je omezena zásobníkem
+   raise ExpressionError(ExprParser.TOO_DEEP, self.peek()[2])
+  if self.peek()[0] != 'end':
+   self.unexpected()
+  return tree
+ 
+ # Parametry (a-d) použité ve stromu, v pořadí Function.PARS
+ @staticmethod
+ def getPars(tree):
+  names = set()
+  stack = [tree]
+  while stack:
+   node = stack.pop()
+   if node[0] == 'var':
+    names.add(node[1])
+   else:
+    stack.extend(child for child in node[1:] if type(child) is tuple)
+  return [par for par in Function.PARS if par in names]
+ 
+ # Tokeny
+ def peek(self, ahead=0):
+  return self.tokens[min(self.index + ahead, len(self.tokens) - 1)]
+ 
+ def next(self):
+  token = self.tokens[self.index]
+  self.index += 1
+  return token
+ 
+ def isOp(self, op, ahead=0):
+  token = self.peek(ahead)
+  return token[0] == 'op' and token[1] == op
+ 
+ def expect(self, op):
+  if not self.isOp(op):
+   self.unexpected()
+  self.next()
+ 
+ def unexpected(self):
+  kind, value, pos = self.peek()
+  if kind == 'end':
+   raise ExpressionError('neočekávaný konec předpisu', pos)
+  raise ExpressionError('neočekávané {0!r}'.format(self.text[pos:].split()[0][:8]), pos)
+ 
+ # Může token začínat činitel implicitního násobení?
+ def startsPrimary(self, ahead=0):
+  kind, value, pos = self.peek(ahead)
+  if kind in ('num', 'var', 'const', 'func'):
+   return True
+  return kind == 'op' and (value in ('(', '[') or (value == '|' and self.absDepth == 0))
+ 
+ # Gramatika
+ def parseSum(self):
+  node = self.parseProduct()
+  while self.isOp('+') or self.isOp('-'):
+   op = self.next()[1]
+   node = ('add' if op == '+' else 'sub', node, self.parseProduct())
+  return node
+ 
+ def parseProduct(self):
+  node = self.parseUnary()
+  while True:
+   if self.isOp('*') or self.isOp('/') or self.isOp('%'):
+    op = self.next()[1]
+    node = ({'*' : 'mul', '/' : 'div', '%' : 'mod'}[op], node, self.parseUnary())
+   elif self.startsPrimary():
+    node = ('mul', node, self.parsePower())
+   else:
+    return node
+ 
+ def parseUnary(self):
+  if self.isOp('-'):
+   self.next()
+   return ('neg', self.parseUnary())
+  elif self.isOp('+'):
+   self.next()
+   return self.parseUnary()
+  return self.parsePower()
+ 
+ # mocnina je zprava asociativní, exponent může mít znaménko (x^-2)
+ def parsePower(self):
+  node = self.parsePrimary()
+  if self.isOp('^'):
+   self.next()
+   return ('pow', node, self.parseUnary())
+  return node
+ 
+ def parsePrimary(self):
+  kind, value, pos = self.peek()
+  if kind == 'num':
+   self.next()
+   return ('num', value)
+  elif kind in ('var', 'const'):
+   self.next()
+   return (kind, value)
+  elif kind == 'func':
+   self.next()
+   return self.parseCall(value)
+  elif self.isOp('('):
+   return self.parseGroup('(', ')')
+  elif self.isOp('['):
+   return ('call', 'int', self.parseGroup('[', ']'))
+  elif self.isOp('|'):
+   self.next()
+   self.absDepth += 1
+   node = self.parseSum()
+   self.absDepth -= 1
+   self.expect('|')
+   return ('call', 'abs', node)
+  self.unexpected()
+ 
+ def parseGroup(self, opening, closing):
+  self.expect(opening)
+  depth = self.absDepth
+  self.absDepth = 0 # uvnitř závorek | zase otevírá
+  node = self.parseSum()
+  self.absDepth = depth
+  self.expect(closing)
+  return node
+ 
+ def parseCall(self, function):
+  if function == 'log':
+   base = self.parseBase()
+   return ('log', self.parseArgument(), base or ('num', 10.0))
+  elif function == 'root':
+   base = self.parseBase(True) or ('num', 2.0)
+   return ('pow', self.parseArgument(), ('div', ('num', 1.0), base))
+  elif function == 'sqrt':
+   return ('pow', self.parseArgument(), ('div', ('num', 1.0), ('num', 2.0)))
+  return ('call', function, self.parseArgument())
+ 
+ # Argument funkce - závorka nebo jeden činitel (sinx, sin2x = sin(2)*x), případně se znaménkem
+ def parseArgument(self):
+  if self.isOp('-') or self.isOp('+'):
+   return self.parseUnary()
+  return self.parsePrimary()
+ 
+ # Základ log a root: číslo hned za názvem, za nímž následuje argument (log2(x), log2x, root3x).
+ # U root může být číslo i v závorce, za níž je závorka nebo proměnná (root(3)(x), root(3)x -
+ # odmocnina jako u dřívějšího zápisu; log(2)(x) je i nadále log(2)*x).
+ def parseBase(self, parenthesized=False):
+  if self.peek()[0] == 'num' and self.startsPrimary(1):
+   return self.parsePrimary()
+  if parenthesized and self.isOp('(') and self.peek(1)[0] == 'num' and self.isOp(')', 2) and \
+   (self.isOp('(', 3) or self.peek(3)[0] == 'var'):
+   self.next()
+   base = self.parsePrimary()
+   self.next()
+   return base
+  return None
+
+
+# Převod stromu výrazu (ExprParser) na kód v Pythonu pro eval (stejný kód slouží i pro NumPy,
+# kde math a mathfx ukazují na funkce NumPy - viz ArrayBackend). Čísla jsou float, takže
+# mocniny celých čísel (10^10^10) jen přetečou a nepočítají se celočíselně donekonečna.
+# Pro výpočet se z výrazu sestaví kód se dvěma funkcemi (getBinder):
+#  def bind(a, b):                 - vazba na parametry, vrací funkci x (hodnota v bodě)
+#   k0 = <vytknutý podvýraz>
+#   return lambda x: <výraz s k0>
+#  def sample(xs, memos, a, b):    - hodnoty pro seznam bodů (None pro nedefinované)
+#   _sin = math.sin                  funkce jako lokální proměnné, smyčka bez volání funkce
+#   ...                              na bod a s ošetřením chyb a komplexních čísel přímo v ní
+# Drahé podvýrazy jen s x (ExprOptimizer.memoize) si sample pamatuje podle x v memos (slovník
+# podle kódu podvýrazu), takže po změně parametru počítá jen zbytek výrazu.
+class ExprCompiler(ComputingClass):
+ NAMESPACE = {'math' : math, 'mathfx' : mathfx}
+ FUNCTIONS = {'sqrt' : 'math.sqrt', 'sin' : 'math.sin', 'cos' : 'math.cos', 'tan' : 'math.tan', 'cot' : 'math.tan',
+  'asin' : 'math.asin', 'acos' : 'math.acos', 'atan' : 'math.atan', 'exp' : 'math.exp', 'ln' : 'math.log',
+  'abs' : 'abs', 'sgn' : 'mathfx.sgn', 'int' : 'int'}
+ OPERATORS = {'add' : '+', 'sub' : '-', 'mul' : '*', 'div' : '/', 'mod' : '%', 'pow' : '**'}
+ CONSTANTS = {'pi' : 'math.pi', 'e' : 'math.e'}
+ # chyby, při nichž je hodnota nedefinovaná (ostatní jsou chybou předpisu)
+ UNDEFINED = '(ArithmeticError, ValueError, TypeError)'
+ 
+ # names - množina, do které se zapisují použité funkce; v kódu se pak volají lokálními jmény
+ @staticmethod
+ def generate(node, names=None):
+  kind = node[0]
+  if kind == 'num':
+   return repr(node[1]) if node[1] >= 0 else '({0!r})'.format(node[1])
+  elif kind == 'var':
+   return node[1]
+  elif kind == 'const':
+   return ExprCompiler.CONSTANTS[node[1]]
+  elif kind == 'neg':
+   return '(-{0})'.format(ExprCompiler.generate(node[1], names))
+  elif kind == 'call':
+   function = ExprCompiler.getFunction(ExprCompiler.FUNCTIONS[node[1]], names)
+   if node[1] == 'cot':
+    return '(1 / {0}({1}))'.format(function, ExprCompiler.generate(node[2], names))
+   return '{0}({1})'.format(function, ExprCompiler.generate(node[2], names))
+  elif kind == 'log':
+   return '{0}({1}, {2})'.format(ExprCompiler.getFunction('math.log', names), ExprCompiler.generate(node[1], names),
+    ExprCompiler.generate(node[2], names))
+  elif kind == 'inv':
+   return 'k{0}'.format(node[1])
+  elif kind == 'memo':
+   return '_v{0}'.format(node[1])
+  elif kind == 'powi':
+   base = ExprCompiler.generate(node[1], names)
+   if node[1][0] in ('var', 'inv', 'memo'):
+    return '({0})'.format(' * '.join([base] * node[2]))
+   return '((_t := {0}) * {1})'.format(base, ' * '.join(['_t'] * (node[2] - 1))) # základ jen jednou
+  return '({0} {1} {2})'.format(ExprCompiler.generate(node[1], names), ExprCompiler.OPERATORS[kind],
+   ExprCompiler.generate(node[2], names))
+ 
+ @staticmethod
+ def getFunction(function, names):
+  if names is None:
+   return function
+  names.add(function)
+  return ExprCompiler.getLocal(function)
+ 
+ @staticmethod
+ def getLocal(function):
+  return '_' + function.split('.')[-1]
+ 
+ # Kód optimalizovaného stromu (ExprOptimizer) pro výpočet,
+ # shared - podvýrazy společné s jinými funkcemi, pamatují se i bez parametrů
+ @staticmethod
+ def generateBinder(tree, pars, shared=frozenset()):
+  body, invariants = ExprOptimizer.prepare(tree)
+  subtrees = []
+  memoized = ExprOptimizer.memoize(body, subtrees, shared, bool(pars))
+  names = set()
+  localCode = [ExprCompiler.generate(node, names) for node in [memoized] + invariants + subtrees]
+  memos = [(ExprCompiler.generate(node), code) for node, code in zip(subtrees, localCode[1 + len(invariants):])]
+  return ExprCompiler.getBind(ExprCompiler.generate(body), pars, [ExprCompiler.generate(node) for node in invariants]) + \
+   ExprCompiler.getSample(localCode[0], pars, localCode[1:1 + len(invariants)], names, memos)
+ 
+ # Kód pro výpočet hotového výrazu (i dříve uloženého exprFin)
+ @staticmethod
+ def getBinder(body, pars, invariants=()):
+  return ExprCompiler.getBind(body, pars, invariants) + ExprCompiler.getSample(body, pars, invariants, (), ())
+ 
+ @staticmethod
+ def getBind(body, pars, invariants):
+  lines = ['def bind({0}):'.format(', '.join(pars))]
+  lines.extend(' k{0} = {1}'.format(i, invariant) for i, invariant in enumerate(invariants))
+  lines.append(' return lambda x: {0}'.format(body))
+  return '\n'.join(lines) + '\n'
+ 
+ # Smyčka přes body - komplexní výsledek neprojde math.isfinite (TypeError), takže se pozná
+ # stejnou výjimkou jako chyba definičního oboru.
+ # memos - (klíč, kód) zapamatovaných podvýrazů; nedefinovaná hodnota podvýrazu se pamatuje jako None.
+ @staticmethod
+ def getSample(body, pars, invariants, names, memos):
+  lines = ['MEMO_KEYS = {0!r}'.format(tuple(key for key, code in memos)), 'def sample({0}):'.format(', '.join(['xs', 'memos'] + pars)), ' _isfinite = math.isfinite']
+  lines.extend(' {0} = {1}'.format(ExprCompiler.getLocal(function), function) for function in sorted(names))
+  if invariants:
+   lines.append(' try:')
+   lines.extend('  k{0} = {1}'.format(i, invariant) for i, invariant in enumerate(invariants))
+   lines.append(' except {0}:'.format(ExprCompiler.UNDEFINED))
+   lines.append('  return [None] * len(xs)')
+  if memos:
+   lines.append(' _miss = object()')
+  for i, (key, code) in enumerate(memos):
+   lines.append(' _m{0} = memos.setdefault({1!r}, {{}})'.format(i, key))
+  lines.extend([' ys = []', ' append = ys.append', ' for x in xs:'])
+  for i, (key, code) in enumerate(memos):
+   lines.extend(['  _v{0} = _m{0}.get(x, _miss)'.format(i), '  if _v{0} is _miss:'.format(i), '   try:',
+    '    _v{0} = {1}'.format(i, code), '   except {0}:'.format(ExprCompiler.UNDEFINED), '    _v{0} = None'.format(i),
+    '   _m{0}[x] = _v{0}'.format(i), '  if _v{0} is None:'.format(i), '   append(None)', '   continue'])
+  lines.extend(['  try:',
+   '   y = {0}'.format(body), '   append(y if _isfinite(y) else None)',
+   '  except {0}:'.format(ExprCompiler.UNDEFINED), '   append(None)', ' return ys'])
+  return '\n'.join(lines) + '\n'
+ 
+ # Sestaví kód ve jmenném prostoru namespace, vrací jmenný prostor s funkcemi bind a sample.
+ @staticmethod
+ def compile(code, namespace):
+  namespace = dict(namespace)
+  exec(code, namespace)
+  return namespace
+
+
+# Zjednodušení stromu výrazu před generováním kódu (simplify): konstantní podvýrazy se vyčíslí,
+# neutrální prvky (x*1, x+0, x^1) vypustí, x^0,5 se počítá jako sqrt a malé celočíselné mocniny
+# násobením (uzel ('powi', základ, n)). Podvýrazy bez x (hoist) se počítají jednou při vazbě
+# na hodnoty parametrů, ne v každém vzorku (uzel ('inv', i)).
+class ExprOptimizer(ComputingClass):
+ name = 'OPTIMIZE'
+ MAX_POWER = 4 # nejvyšší mocnina rozepsaná na násobení
+ MEMO_COST = 2 # nejmenší počet volání funkcí v podvýrazu, který si sample pamatuje
+ CONSTANTS = {'pi' : math.pi, 'e' : math.e}
+ 
+ @staticmethod
+ def simplify(node):
+  kind = node[0]
+  if kind == 'const':
+   return ('num', ExprOptimizer.CONSTANTS[node[1]])
+  elif kind in ('num', 'var'):
+   return node
+  node = (kind,) + tuple(ExprOptimizer.simplify(child) if type(child) is tuple else child for child in node[1:])
+  if all(child[0] == 'num' for child in node[1:] if type(child) is tuple):
+   value = ExprOptimizer.fold(node)
+   if value is not None:
+    return ('num', value)
+  return ExprOptimizer.reduce(node)
+ 
+ # Hodnota konstantního podvýrazu, None, pokud není konečné reálné číslo (ten se pak počítá
+ # až při vzorkování a dá nedefinovanou hodnotu). Čísla jsou float, výpočet nemůže uvíznout.
+ @staticmethod
+ def fold(node):
+  try:
+   value = float(eval(ExprCompiler.generate(node), ExprCompiler.NAMESPACE))
+  except (ArithmeticError, ValueError, TypeError):
+   return None
+  if not math.isfinite(value):
+   return None
+  return value
+ 
+ @staticmethod
+ def reduce(node):
+  kind = node[0]
+  zero, one = ('num', 0.0), ('num', 1.0)
+  if kind == 'neg' and node[1][0] == 'neg':
+   return node[1][1]
+  elif kind in ('add', 'sub') and node[2] == zero:
+   return node[1]
+  elif kind == 'add' and node[1] == zero:
+   return node[2]
+  elif kind in ('mul', 'div') and node[2] == one:
+   return node[1]
+  elif kind == 'mul' and node[1] == one:
+   return node[2]
+  elif kind == 'pow' and node[2][0] == 'num':
+   exponent = node[2][1]
+   if exponent == 1:
+    return node[1]
+   elif exponent == 0.5:
+    return ('call', 'sqrt', node[1])
+   elif exponent == int(exponent) and 2 <= abs(exponent) <= ExprOptimizer.MAX_POWER:
+    power = ('powi', node[1], int(abs(exponent)))
+    return power if exponent > 0 else ('div', one, power)
+  return node
+ 
+ # Nahradí největší podvýrazy bez x uzly ('inv', i), vrací (strom, seznam vytknutých podvýrazů).
+ @staticmethod
+ def hoist(tree):
+  invariants = []
+  return ExprOptimizer.hoistNode(tree, invariants), invariants
+ 
+ @staticmethod
+ def hoistNode(node, invariants):
+  if node[0] in ('num', 'var'):
+   return node
+  elif not ExprOptimizer.usesX(node):
+   if node not in invariants:
+    invariants.append(node)
+   return ('inv', invariants.index(node))
+  return (node[0],) + tuple(ExprOptimizer.hoistNode(child, invariants) if type(child) is tuple else child for child in node[1:])
+ 
+ # Strom pro generování kódu: zjednodušený, s vytknutými podvýrazy bez x a se seskupenými
+ # operandy jen s x (regroup), vrací (strom, vytknuté podvýrazy).
+ @staticmethod
+ def prepare(tree):
+  body, invariants = ExprOptimizer.hoist(ExprOptimizer.simplify(tree))
+  return ExprOptimizer.regroup(body), invariants
  
- # Kouskuje předpis.
+ # a*sin(x)*log(x) -> a*(sin(x)*log(x)) - operandy jen s x tvoří jediný podvýraz (k zapamatování)
  @staticmethod
- def preparePart(rec):
-  all = rec.group(0)
-  parEnd = Function.endOfParth(all)
-  return (all[:parEnd], all[parEnd:])
+ def regroup(node):
+  if node[0] in ('num', 'var', 'inv'):
+   return node
+  node = (node[0],) + tuple(ExprOptimizer.regroup(child) if type(child) is tuple else child for child in node[1:])
+  if node[0] in ('add', 'mul'):
+   operands = ExprOptimizer.flatten(node, node[0])
+   xOnly = [operand for operand in operands if ExprOptimizer.usesX(operand) and ExprOptimizer.isXOnly(operand)]
+   if 1 < len(xOnly) < len(operands):
+    rest = [operand for operand in operands if operand not in xOnly]
+    return ExprOptimizer.chain(node[0], rest + [ExprOptimizer.chain(node[0], xOnly)])
+  return node
+ 
+ # Nahradí drahé podvýrazy jen s x (bez parametrů) uzly ('memo', i) - jejich hodnoty nezávisí
+ # na parametrech, sample je tedy počítá pro každé x jen jednou. U funkce s parametry se pamatují
+ # největší takové podvýrazy, podvýrazy ze shared (společné s jinými funkcemi) vždy.
+ @staticmethod
+ def memoize(node, subtrees, shared, parametric):
+  if node[0] in ('num', 'var', 'inv'):
+   return node
+  elif ExprOptimizer.isXOnly(node) and ExprOptimizer.isExpensive(node) and \
+   (node in shared or (parametric and not ExprOptimizer.getShareable(node) & shared)):
+   if node not in subtrees:
+    subtrees.append(node)
+   return ('memo', subtrees.index(node))
+  return (node[0],) + tuple(ExprOptimizer.memoize(child, subtrees, shared, parametric) if type(child) is tuple else child
+   for child in node[1:])
+ 
+ # Všechny podvýrazy, které se vyplatí pamatovat (kandidáti na sdílení mezi funkcemi)
+ @staticmethod
+ def getShareable(node):
+  subtrees = set()
+  stack = [node]
+  while stack:
+   node = stack.pop()
+   if ExprOptimizer.isXOnly(node) and ExprOptimizer.isExpensive(node):
+    subtrees.add(node)
+   stack.extend(child for child in node[1:] if type(child) is tuple)
+  return subtrees
+ 
+ # Operandy řetězce stejné operace ((a + b) + c -> [a, b, c])
+ @staticmethod
+ def flatten(node, kind):
+  if node[0] != kind:
+   return [node]
+  return ExprOptimizer.flatten(node[1], kind) + ExprOptimizer.flatten(node[2], kind)
+ 
+ @staticmethod
+ def chain(kind, operands):
+  node = operands[0]
+  for operand in operands[1:]:
+   node = (kind, node, operand)
+  return node
+ 
+ @staticmethod
+ def isXOnly(node):
+  if node[0] == 'var':
+   return node[1] == 'x'
+  elif node[0] == 'inv':
+   return False
+  return all(ExprOptimizer.isXOnly(child) for child in node[1:] if type(child) is tuple)
+ 
+ # Vyplatí se pamatovat? Vyhledání ve slovníku stojí zhruba jako jedno volání funkce math.
+ @staticmethod
+ def isExpensive(node):
+  return ExprOptimizer.getCost(node) >= ExprOptimizer.MEMO_COST
+ 
+ @staticmethod
+ def getCost(node):
+  cost = 1 if node[0] in ('call', 'log', 'pow') else 0
+  return cost + sum(ExprOptimizer.getCost(child) for child in node[1:] if type(child) is tuple)
+ 
+ @staticmethod
+ def usesX(node):
+  if node[0] == 'var':
+   return node[1] == 'x'
+  return any(ExprOptimizer.usesX(child) for child in node[1:] if type(child) is tuple)
+
+
+# Vyhodnocování předpisu - vektorově přes NumPy (useArray), jinak bod po bodu. Nezávisí
+# na konfiguraci ani na stavu programu, takže se dá sestavit i v podřízeném procesu.
+# code - kód předpisu (ExprCompiler.getBinder), vázaná funkce x se uchovává pro poslední
+# hodnoty parametrů, seznamy bodů bez NumPy počítá vygenerovaná smyčka sample.
+class Evaluator(ComputingClass):
+ name = 'EXPR'
+ MEMO_SIZE = 100000 # nejvýš zapamatovaných hodnot jednoho podvýrazu
+ # memos - zapamatované hodnoty podvýrazů jen s x (kód podvýrazu -> {x : hodnota}), i společné
+ def __init__(self, code, pars, useArray, memos=None):
+  self.pars = pars
+  functions = ExprCompiler.compile(code, ExprCompiler.NAMESPACE)
+  self.bind = functions['bind']
+  self.sample = functions['sample']
+  self.memoKeys = functions['MEMO_KEYS']
+  self.memos = {} if memos is None else memos
+  self.bound = (None, None) # (hodnoty parametrů, funkce x)
+  if useArray:
+   self.arrayBind = ArrayBackend.compileBinder(code)
+  else:
+   self.arrayBind = None
+  self.arrayBound = (None, None)
+ 
+ # Funkce x pro hodnoty parametrů par, None, pokud je pro ně předpis všude nedefinovaný.
+ def getFunction(self, par, array=False):
+  key = tuple(par[name] for name in self.pars)
+  bound = self.arrayBound if array else self.bound
+  if bound[0] != key:
+   try:
+    if array:
+     bound = (key, ArrayBackend.bind(self.arrayBind, par))
+    else:
+     bound = (key, self.bind(**par))
+   except (ArithmeticError, ValueError, TypeError):
+    bound = (key, None)
+   except MemoryError:
+    raise
+   except Exception as message:
+    raise FunctionError(message)
+   if array:
+    self.arrayBound = bound
+   else:
+    self.bound = bound
+  return bound[1]
+ 
+ # Hodnota v bodě x, pro nedefinovanou hodnotu a imag. číslo None.
+ def getValue(self, x, **par):
+  return Evaluator.evaluate(self.getFunction(par), x)
+ 
+ @staticmethod
+ def evaluate(function, x):
+  if function is None:
+   return None
+  try:
+   res = function(x)
+   if type(res) is type(1j) or not math.isfinite(res): return None
+   else: return res
+  except (ArithmeticError, ValueError, TypeError):
+   return None
+  except MemoryError:
+   raise
+  except Exception as message:
+   raise FunctionError(message)
+ 
+ # Hodnoty pro celý seznam bodů - při chybě vektorového výpočtu přejde natrvalo na bodový.
+ def getValues(self, xs, **par):
+  if self.arrayBind is not None:
+   try:
+    function = self.getFunction(par, True)
+    if function is None:
+     return [None] * len(xs)
+    return ArrayBackend.getValues(function, xs)
+   except Exception as message:
+    self.log('array evaluation failed, falling back to pointwise ({0})'.format(message))
+    self.arrayBind = None
+  for key in self.memoKeys:
+   memo = self.memos.get(key)
+   if memo is not None and len(memo) > Evaluator.MEMO_SIZE:
+    memo.clear()
+  try:
+   return self.sample(xs, self.memos, **par)
+  except MemoryError:
+   raise
+  except Exception as message:
+   raise FunctionError(message)
+
+
+# Sestavené předpisy (Evaluator) sdílené v rámci procesu, klíčem je kód předpisu - ten vzniká
+# z normalizovaného stromu (ExprCompiler.generateBinder), takže stejné funkce (i zapsané jinak,
+# 2x a 2*x) se sestavují jen jednou. Počet je omezen, vyřazují se nejdéle nepoužité.
+# Všechny předpisy sdílejí memos (zapamatované hodnoty podvýrazů podle kódu podvýrazu).
+class EvaluatorCache(ComputingClass):
+ name = 'EVALCACHE'
+ def __init__(self, size):
+  self.size = max(1, size)
+  self.evaluators = collections.OrderedDict()
+  self.memos = {}
+  self.hits = 0
+  self.misses = 0
+ 
+ def get(self, code, pars, useArray):
+  key = (code, tuple(pars), useArray)
+  evaluator = self.evaluators.get(key)
+  if evaluator is None:
+   self.misses += 1
+   evaluator = Evaluator(code, pars, useArray, self.memos)
+   self.evaluators[key] = evaluator
+   if len(self.evaluators) > self.size:
+    self.evaluators.popitem(last=False)
+  else:
+   self.hits += 1
+   self.evaluators.move_to_end(key)
+  return evaluator
+ 
+ def clear(self):
+  self.evaluators.clear()
+  self.memos.clear()
+ 
+ def clearMemos(self):
+  self.memos.clear()
+ 
+ def getStats(self):
+  return self.hits, self.misses, len(self.evaluators)
 
- # Detekuje přebytečné závorky.
+
+# Vzorky drahých funkcí na disku (volitelné, gridpar sample-cache) - po novém spuštění se stejný
+# pohled vykreslí bez výpočtu. Klíčem je hash předpisu, hodnot parametrů, intervalu a nastavení
+# vzorkovače. Soubor obsahuje hlavičku (FCS1, počet vzorků) a pak x a y jako float64 little-endian
+# (NaN = nedefinovaná hodnota). Nad sample-cache-size MB se mažou nejdéle nepoužité soubory.
+class SampleCache(ComputingClass):
+ name = 'SAMPLECACHE'
+ MAGIC = b'FCS1'
+ HEADER = struct.Struct('<4sI')
+ EXT = '.smp'
+ 
+ def __init__(self, path, size):
+  self.path = path
+  self.size = size * 1024 * 1024
+  os.makedirs(path, exist_ok=True)
+ 
  @staticmethod
- def endOfParth(all):
-  opens = 0
-  closes = 0
-  for i in range(len(all)):
-   if all[i] == '(':
-    opens += 1
-   elif all[i] == ')':
-    closes += 1
-   if closes == opens and opens != 0:
-    return i+1
- 
- # Upravuje zápis odmocnin.
+ def getKey(expr, parValues, low, high, settings):
+  return hashlib.sha1(repr((expr, tuple(parValues), low, high, settings)).encode('utf-8')).hexdigest()
+ 
+ def getFileName(self, key):
+  return os.path.join(self.path, key + SampleCache.EXT)
+ 
+ # Vzorky (xs, ys) všech klíčů, nebo None, pokud některý v cache chybí
+ def loadAll(self, keys):
+  results = []
+  for key in keys:
+   samples = self.load(key)
+   if samples is None:
+    return None
+   results.append(samples)
+  return results
+ 
+ def load(self, key):
+  fileName = self.getFileName(key)
+  try:
+   with open(fileName, 'rb') as file:
+    data = file.read()
+   os.utime(fileName) # naposledy použito - pro vyřazování
+  except OSError:
+   return None
+  if len(data) < SampleCache.HEADER.size:
+   return None
+  magic, count = SampleCache.HEADER.unpack_from(data)
+  if magic != SampleCache.MAGIC or len(data) != SampleCache.HEADER.size + 16 * count:
+   return None
+  values = array.array('d')
+  values.frombytes(data[SampleCache.HEADER.size:])
+  if sys.byteorder != 'little':
+   values.byteswap()
+  return values[:count].tolist(), [None if y != y else y for y in values[count:].tolist()]
+ 
+ # results - viz SampleJob.getResults
+ def storeAll(self, keys, results):
+  for key, (side, (xs, ys)) in zip(keys, results):
+   self.store(key, xs, ys)
+  self.evict()
+ 
+ def store(self, key, xs, ys):
+  values = array.array('d', xs)
+  values.extend(math.nan if y is None else y for y in ys)
+  if sys.byteorder != 'little':
+   values.byteswap()
+  fileName = self.getFileName(key)
+  tempName = '{0}.{1}.tmp'.format(fileName, os.getpid())
+  try:
+   with open(tempName, 'wb') as file:
+    file.write(SampleCache.HEADER.pack(SampleCache.MAGIC, len(xs)))
+    file.write(values.tobytes())
+   os.replace(tempName, fileName)
+  except OSError as error:
+   self.log('sample cache write failed ({0})'.format(error))
+ 
+ def evict(self):
+  try:
+   entries = []
+   for entry in os.scandir(self.path):
+    if entry.name.endswith(SampleCache.EXT):
+     stat = entry.stat()
+     entries.append((stat.st_mtime, stat.st_size, entry.path))
+  except OSError:
+   return
+  total = sum(size for mtime, size, path in entries)
+  for mtime, size, path in sorted(entries):
+   if total <= self.size:
+    break
+   try:
+    os.remove(path)
+   except OSError:
+    pass
+   total -= size
+
+
+# Adaptivní vzorkování funkce. Začíná řídkou pravidelnou mřížkou a dělí intervaly na čtvrtiny
+# (tři vzorky - střed a čtvrtiny), dokud se některý z nich v pixelech odchyluje od tětivy víc
+# než o toleranci (nebo kde začíná či končí definiční obor). Jediný střed by přehlédl kmitání
+# uvnitř intervalu, které ho náhodou protne blízko tětivy (sin(1/x)). Každý interval počáteční
+# mřížky se rozdělí aspoň jednou, za rovný se tedy uzná až podle vzorků po čtvrtině jejího kroku.
+# Končí na šířce intervalu pod pixel nebo po vyčerpání rozpočtu vzorků.
+# Hodnoty se počítají po celých vrstvách dělení, takže vektorový výpočet zůstává výhodný.
+class AdaptiveSampler(ComputingClass):
+ def __init__(self, getValues, xUnitPx, yUnitPx, tolerance, minWidth, startSteps, budget, timeLimit=None, cancelled=None):
+  self.getValues = getValues
+  self.timeLimit = timeLimit # s, po jeho vypršení se půlení ukončí (truncated)
+  self.cancelled = cancelled # volitelná funkce - vrací True, pokud se má půlení ukončit
+  self.truncated = False
+  self.xUnitPx = xUnitPx
+  self.yUnitPx = yUnitPx
+  self.tolerance = tolerance
+  self.minWidth = minWidth
+  self.startSteps = max(1, min(startSteps, budget))
+  self.budget = budget
+ 
+ # Parametry vzorkovače pro jeden z count stejných dílů intervalu (bez getValues)
+ def getSettings(self, count):
+  return (self.xUnitPx, self.yUnitPx, self.tolerance, self.minWidth,
+   max(1, self.startSteps // count), max(2, self.budget // count), self.timeLimit)
+ 
+ # Vrací seznamy x a y (None pro nedefinované hodnoty) vzorků na intervalu <low, high>.
+ def sample(self, low, high):
+  if self.timeLimit is not None:
+   deadline = time.perf_counter() + self.timeLimit
+  step = (high - low) / self.startSteps
+  xs = [low + step * i for i in range(self.startSteps)] + [high]
+  ys = self.getValues(xs)
+  # odhad chyby intervalu (i, i+1), None = interval je hotový; počáteční mřížka se dělí vždy
+  errors = [float('inf')] * self.startSteps
+  while len(xs) + 3 <= self.budget:
+   if self.cancelled is not None and self.cancelled(): break
+   if self.timeLimit is not None and time.perf_counter() > deadline:
+    self.truncated = True
+    break
+   toSplit = [i for i in range(len(errors)) if errors[i] is not None and (xs[i+1] - xs[i]) * self.xUnitPx > self.minWidth]
+   if not toSplit: break
+   free = (self.budget - len(xs)) // 3
+   if len(toSplit) > free:
+    toSplit = sorted(heapq.nlargest(free, toSplit, key=errors.__getitem__))
+   probeXs = []
+   for i in toSplit:
+    quarter = (xs[i+1] - xs[i]) / 4
+    probeXs.extend((xs[i] + quarter, xs[i] + 2 * quarter, xs[i] + 3 * quarter))
+   probeYs = self.getValues(probeXs)
+   xs, ys, errors = self.merge(xs, ys, errors, toSplit, probeXs, probeYs)
+  return xs, ys
+ 
+ # Vkládá vzorky (po třech na dělený interval) a určuje, které čtvrtiny se budou dělit dál.
+ def merge(self, xs, ys, errors, toSplit, probeXs, probeYs):
+  newXs, newYs, newErrors = [], [], []
+  last = 0
+  for n, i in enumerate(toSplit):
+   newXs.extend(xs[last:i+1])
+   newYs.extend(ys[last:i+1])
+   newErrors.extend(errors[last:i])
+   q1, mid, q3 = probeYs[3*n:3*n+3]
+   error = self.getError(ys[i], q1, mid, q3, ys[i+1])
+   newXs.extend(probeXs[3*n:3*n+3])
+   newYs.extend((q1, mid, q3))
+   newErrors.extend((error,) * 4)
+   last = i + 1
+  newXs.extend(xs[last:])
+  newYs.extend(ys[last:])
+  newErrors.extend(errors[last:])
+  return newXs, newYs, newErrors
+ 
+ # Největší odchylka středu od tětivy intervalu a čtvrtin od tětiv polovin v pixelech;
+ # None, pokud interval není třeba dál dělit.
+ def getError(self, y1, yQ1, yMid, yQ3, y2):
+  values = (y1, yQ1, yMid, yQ3, y2)
+  defined = sum(y is not None for y in values)
+  if defined == 0:
+   return None
+  elif defined < len(values):
+   return float('inf') # hranice definičního oboru - dohledat
+  error = max(abs(yMid - (y1 + y2) / 2), abs(yQ1 - (y1 + yMid) / 2), abs(yQ3 - (yMid + y2) / 2)) * self.yUnitPx
+  if error > self.tolerance:
+   return error
+  else:
+   return None
+
+
+# Úloha vzorkování jedné funkce - které intervaly dopočítat (celý rozsah, nebo odkryté kraje)
+# a čím. Výpočet (run) nesahá na stav funkce ani pohledu, může tedy běžet ve vlákně;
+# výsledek vkládá Function.applySamples v hlavním vlákně.
+class SampleJob(ComputingClass):
+ def __init__(self, fid, generation, key, keep, expr, reduced=False):
+  self.fid = fid
+  self.generation = generation
+  self.key = key
+  self.keep = keep
+  self.expr = expr # (kód předpisu, pars, hodnoty parametrů, useArray) - pro výpočet v jiném procesu
+  self.parts = [] # (strana, dolní mez, horní mez, vzorkovač)
+  self.results = None
+  self.error = None
+  self.cancelled = False
+  self.reduced = reduced # snížený rozpočet nebo vypršel časový limit
+  self.elapsed = 0
+  self.cacheKeys = None # klíče částí v diskové cache (SampleCache)
+  self.cached = False
+  self.yUnitPx = None # měřítko y při plánování (tolerance vzorkování)
+ 
+ def addPart(self, side, low, high, getSampler):
+  self.parts.append((side, low, high, getSampler(low, high, self.isCancelled)))
+ 
+ def isEmpty(self):
+  return not self.parts
+ 
+ def run(self):
+  start = time.perf_counter()
+  results = [sampler.sample(low, high) for side, low, high, sampler in self.parts]
+  self.setResults(results, time.perf_counter() - start, any(part[3].truncated for part in self.parts))
+  return self
+ 
+ def getParts(self):
+  return self.parts
+ 
+ # Zadání částí pro výpočet v jiném procesu (předpis jako text a parametry vzorkovače)
+ def getRequests(self):
+  return [self.expr + (sampler.getSettings(1), low, high) for side, low, high, sampler in self.parts]
+ 
+ # elapsed - čas výpočtu (pro cenu vzorku), truncated - některý vzorkovač vyčerpal časový limit
+ def setResults(self, results, elapsed, truncated):
+  self.results = results
+  self.elapsed = elapsed
+  self.reduced = self.reduced or truncated
+ 
+ def isReduced(self):
+  return self.reduced
+ 
+ # Výsledky z diskové cache - úloha se nepočítá
+ def setCached(self, results):
+  self.cached = True
+  self.reduced = False
+  self.setResults(results, 0, False)
+ 
+ def isCached(self):
+  return self.cached
+ 
+ def getResults(self):
+  return [(part[0], result) for part, result in zip(self.parts, self.results)]
+ 
+ def cancel(self):
+  self.cancelled = True
+ 
+ def isCancelled(self):
+  return self.cancelled
+
+
+# Výpočet vzorků na pozadí (ThreadPoolExecutor). Nová úloha funkce zruší její starší úlohu,
+# výsledky vyzvedává hlavní vlákno přes after a předává je apply (zastaralé zahodí
+# Function.applySamples podle generation), takže okno neblokuje ani drahý předpis.
+class EvaluationPool(ComputingClass):
+ name = 'EVAL'
+ def __init__(self, workers, apply):
+  self.workers = workers
+  self.executor = self.createExecutor(workers)
+  self.apply = apply
+  self.interval = conf.get('gridpar', 'frame-interval')
+  self.jobs = {} # fid -> (úloha, seznam futures)
+  self.polling = None
+ 
+ def createExecutor(self, workers):
+  return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+ 
+ def submit(self, job):
+  self.cancel(job.fid)
+  self.jobs[job.fid] = (job, self.start(job))
+  if self.polling is None:
+   self.polling = win.after(self.interval, self.poll)
+ 
+ # Odešle úlohu ke spočtení, vrací seznam jejích futures
+ def start(self, job):
+  return [self.executor.submit(job.run)]
+ 
+ # Všechny části úlohy doběhly - výsledky jsou už v úloze
+ def finish(self, job, futures):
+  pass
+ 
+ def cancel(self, fid):
+  if fid in self.jobs:
+   job, futures = self.jobs.pop(fid)
+   job.cancel()
+   for future in futures:
+    future.cancel()
+   self.discard(job)
+ 
+ # Zastaví výpočet úlohy, která už běží
+ def interrupt(self, job):
+  job.cancel()
+ 
+ # Uklidí po zrušené úloze
+ def discard(self, job):
+  pass
+ 
+ # Vyzvedne hotové úlohy, dokud nějaké běží
+ def poll(self):
+  self.polling = None
+  done = [(job, futures) for job, futures in self.jobs.values() if all(future.done() for future in futures)]
+  for job, futures in done:
+   del self.jobs[job.fid]
+  if self.jobs:
+   self.polling = win.after(self.interval, self.poll)
+  # chyba jedné úlohy se ohlásí až po vložení ostatních hotových (jinak by se ztratily)
+  error = None
+  for job, futures in done:
+   errors = [future.exception() for future in futures if future.exception() is not None]
+   try:
+    if errors:
+     self.discard(job)
+     job.error = errors[0]
+    else:
+     self.finish(job, futures)
+    self.apply(job)
+   except Exception as exc:
+    if error is None:
+     error = exc
+  if error is not None:
+   raise error
+ 
+ # Konec programu - zruší čekající úlohy, počká na běžící (vzorkovač zrušené úlohy skončí hned,
+ # díl v podřízeném procesu se dopočítá) a teprve potom uklidí jejich prostředky (sdílenou paměť).
+ def shutdown(self):
+  jobs = list(self.jobs.values())
+  self.jobs = {}
+  for job, futures in jobs:
+   self.interrupt(job)
+  self.executor.shutdown(wait=True, cancel_futures=True)
+  for job, futures in jobs:
+   self.discard(job)
+
+
+# Výpočet vzorků v podřízených procesech (ProcessPoolExecutor) - využije všechna jádra.
+# Každý interval úlohy se rozdělí na díly podle počtu procesů; do procesu jde jen předpis
+# jako text (kód předpisu, pars) a hodnoty parametrů, vzorky se vracejí ve sdílené paměti
+# (x a pak y jako float64, NaN = nedefinovaná hodnota), nikoli jako seznamy přes pickle.
+# Poslední float64 bloku je příznak zrušení - podřízený proces podle něj ukončí vzorkování.
+class ProcessEvaluationPool(EvaluationPool):
+ name = 'PROC'
+ evaluators = EvaluatorCache(64) # sestavené předpisy v podřízeném procesu
+ 
+ def createExecutor(self, workers):
+  return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+ 
+ def start(self, job):
+  code, pars, parDict, useArray = job.expr
+  total = sum(high - low for side, low, high, sampler in job.getParts())
+  job.chunks = [] # (index části, sdílená paměť, kapacita)
+  futures = []
+  for i, (side, low, high, sampler) in enumerate(job.getParts()):
+   count = max(1, int(round(self.workers * (high - low) / total)))
+   settings = sampler.getSettings(count)
+   capacity = max(settings[4], settings[5]) + 1
+   step = (high - low) / count
+   for k in range(count):
+    chunkHigh = high if k == count - 1 else low + step * (k + 1)
+    block = shared_memory.SharedMemory(create=True, size=(2 * capacity + 1) * 8)
+    job.chunks.append((i, block, capacity))
+    futures.append(self.executor.submit(ProcessEvaluationPool.sampleChunk, code, pars, parDict, useArray,
+     settings, low + step * k, chunkHigh, block.name, capacity))
+  return futures
+ 
+ # Skládá díly zpět do výsledků jednotlivých částí úlohy
+ def finish(self, job, futures):
+  results = [([], []) for part in job.getParts()]
+  elapsed = 0
+  truncated = False
+  for (i, block, capacity), future in zip(job.chunks, futures):
+   count, chunkElapsed, chunkTruncated = future.result()
+   elapsed += chunkElapsed
+   truncated = truncated or chunkTruncated
+   values = block.buf.cast('d')
+   xs = values[:count].tolist()
+   ys = [None if y != y else y for y in values[capacity:capacity + count].tolist()]
+   values.release()
+   partXs, partYs = results[i]
+   start = 1 if partXs else 0 # krajní bod dílu je i prvním bodem dalšího
+   partXs.extend(xs[start:])
+   partYs.extend(ys[start:])
+  self.discard(job)
+  job.setResults(results, elapsed, truncated)
+ 
+ def interrupt(self, job):
+  job.cancel()
+  self.stopChunks(job)
+ 
+ # Příznak zrušení - díl, který ještě běží, skončí
+ def stopChunks(self, job):
+  for i, block, capacity in job.chunks:
+   values = block.buf.cast('d')
+   values[2 * capacity] = 1
+   values.release()
+ 
+ def discard(self, job):
+  self.stopChunks(job)
+  for i, block, capacity in job.chunks:
+   block.close()
+   block.unlink()
+  job.chunks = []
+ 
+ # Běží v podřízeném procesu: navzorkuje díl <low, high> a zapíše ho do sdílené paměti,
+ # vrací počet vzorků, čas výpočtu a zda vypršel časový limit.
  @staticmethod
- def substRoot(rec):
-  toSubst, hang = Function.preparePart(rec)
-  mainExpr = '(' + toSubst[4:].split('(', 1)[-1][:-1] + ')**(1/(' + toSubst[4:].split('(')[0] + '))'
-  return mainExpr + hang
+ def sampleChunk(code, pars, parDict, useArray, settings, low, high, blockName, capacity):
+  evaluator = ProcessEvaluationPool.evaluators.get(code, pars, useArray)
+  block = shared_memory.SharedMemory(name=blockName)
+  values = block.buf.cast('d')
+  start = time.perf_counter()
+  sampler = AdaptiveSampler((lambda xs: evaluator.getValues(xs, **parDict)), *settings,
+   cancelled=(lambda: values[2 * capacity] != 0))
+  xs, ys = sampler.sample(low, high)
+  elapsed = time.perf_counter() - start
+  values[:len(xs)] = array.array('d', xs)
+  values[capacity:capacity + len(ys)] = array.array('d', [float('nan') if y is None else y for y in ys])
+  values.release()
+  block.close()
+  return len(xs), elapsed, sampler.truncated
+
+
+# Hlídaný výpočet - vzorkuje v trvalém podřízeném procesu s omezenou pamětí (RLIMIT_AS,
+# jen POSIX) a s časovým limitem guard-timeout. Proces, který limit překročí, se ukončí
+# (příště se spustí nový) a výpočet skončí výjimkou EvaluationGuardError.
+class EvaluationGuard(ComputingClass):
+ name = 'GUARD'
+ def __init__(self, timeout, memory):
+  self.timeout = timeout
+  self.memory = memory
+  self.process = None
+  self.connection = None
  
- # Upravuje zápis logaritmů.
+ def start(self):
+  self.connection, child = multiprocessing.Pipe()
+  self.process = multiprocessing.Process(target=EvaluationGuard.serve, args=(child, self.memory), daemon=True)
+  self.process.start()
+  child.close()
+ 
+ # Ukončí proces bez úklidu spojení - vlákno, které na něj čeká, dostane EOFError
+ def kill(self):
+  process = self.process
+  if process is not None:
+   process.kill()
+ 
+ def stop(self):
+  if self.process is not None:
+   self.process.kill()
+   self.process.join()
+   self.connection.close()
+   self.process = None
+ 
+ # request - viz SampleJob.getRequests; vrací (xs, ys, truncated)
+ def sample(self, request):
+  if self.process is None or not self.process.is_alive():
+   self.start()
+  self.connection.send(request)
+  if not self.connection.poll(self.timeout):
+   self.stop()
+   raise EvaluationGuardError('time limit exceeded ({0} s)'.format(self.timeout))
+  try:
+   status, result = self.connection.recv()
+  except EOFError:
+   self.stop()
+   raise EvaluationGuardError('evaluation process terminated')
+  if status == 'memory':
+   raise EvaluationGuardError('memory limit exceeded ({0} MB)'.format(self.memory))
+  elif status == 'error':
+   raise FunctionError(result)
+  return result
+ 
+ # Běží v podřízeném procesu: vyřizuje zadání, dokud se spojení neuzavře.
+ @staticmethod
+ def serve(connection, memory):
+  if resource is not None and memory:
+   limit = memory * 1024 * 1024
+   resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+  evaluators = EvaluatorCache(64)
+  while True:
+   try:
+    code, pars, parDict, useArray, settings, low, high = connection.recv()
+   except EOFError:
+    break
+   try:
+    evaluator = evaluators.get(code, pars, useArray)
+    sampler = AdaptiveSampler((lambda xs: evaluator.getValues(xs, **parDict)), *settings)
+    xs, ys = sampler.sample(low, high)
+    connection.send(('ok', (xs, ys, sampler.truncated)))
+   except MemoryError:
+    evaluators.clear()
+    connection.send(('memory', None))
+   except Exception as message:
+    connection.send(('error', str(message)))
+
+
+# Výpočet na pozadí přes hlídané procesy (EvaluationGuard) - každé vlákno poolu si na dobu
+# úlohy půjčí jeden hlídaný proces a čeká na něj, hlavní vlákno se tedy nikdy nezablokuje.
+class GuardedEvaluationPool(EvaluationPool):
+ name = 'GUARD'
+ def __init__(self, workers, apply):
+  EvaluationPool.__init__(self, workers, apply)
+  self.guards = queue.Queue()
+  self.allGuards = [EvaluationGuard(conf.get('gridpar', 'guard-timeout'), conf.get('gridpar', 'guard-memory'))
+   for i in range(workers)]
+  for guard in self.allGuards:
+   self.guards.put(guard)
+ 
+ def start(self, job):
+  return [self.executor.submit(self.runGuarded, job)]
+ 
+ def runGuarded(self, job):
+  guard = self.guards.get()
+  try:
+   start = time.perf_counter()
+   results = []
+   truncated = False
+   for request in job.getRequests():
+    xs, ys, partTruncated = guard.sample(request)
+    results.append((xs, ys))
+    truncated = truncated or partTruncated
+   job.setResults(results, time.perf_counter() - start, truncated)
+  finally:
+   self.guards.put(guard)
+ 
+ # Vlákna čekající na hlídaný proces (až guard-timeout) se uvolní jeho ukončením
+ def shutdown(self):
+  for guard in self.allGuards:
+   guard.kill()
+  EvaluationPool.shutdown(self)
+  for guard in self.allGuards:
+   guard.stop()
+
+
+# Ořez čar na obdélník plátna s okrajem (Liang-Barsky). Úseky mimo se vypustí, takže
+# běh vzorků mimo plátno (u asymptot až miliony pixelů daleko) zkrátí na průsečík s okrajem
+# a čára pokračuje novým úsekem až tam, kde se na plátno vrátí.
+class LineClipper(ComputingClass):
+ def __init__(self, xMin, yMin, xMax, yMax):
+  self.xMin = xMin
+  self.yMin = yMin
+  self.xMax = xMax
+  self.yMax = yMax
+ 
+ # Plátno pohledu rozšířené o clip-margin (podíl rozměru plátna) na každou stranu
+ @staticmethod
+ def forView(view):
+  xMargin = view.wVal * conf.get('gridpar', 'clip-margin')
+  yMargin = view.hVal * conf.get('gridpar', 'clip-margin')
+  return LineClipper(-xMargin, -yMargin, view.wVal + xMargin, view.hVal + yMargin)
+ 
+ def clipAll(self, pointList):
+  clipped = []
+  for points in pointList:
+   clipped.extend(self.clip(points))
+  return clipped
+ 
+ # Vrací seznam úseků, na které se čára [x1, y1, x2, y2...] ořezem rozpadne.
+ def clip(self, points):
+  lines = []
+  line = None
+  for i in range(0, len(points) - 2, 2):
+   x0, y0, x1, y1 = points[i:i+4]
+   if not (self.isInside(x0, y0) and self.isInside(x1, y1)):
+    clipped = self.clipSegment(x0, y0, x1, y1)
+    if clipped is None:
+     line = None
+     continue
+    x0, y0, x1, y1 = [int(round(coor)) for coor in clipped]
+   if line is None or line[-2] != x0 or line[-1] != y0:
+    line = [x0, y0]
+    lines.append(line)
+   line.append(x1)
+   line.append(y1)
+  return lines
+ 
+ def isInside(self, x, y):
+  return self.xMin <= x <= self.xMax and self.yMin <= y <= self.yMax
+ 
+ # Ořez jedné úsečky, None pokud leží celá mimo
+ def clipSegment(self, x0, y0, x1, y1):
+  t0, t1 = 0.0, 1.0
+  dx = x1 - x0
+  dy = y1 - y0
+  for p, q in ((-dx, x0 - self.xMin), (dx, self.xMax - x0), (-dy, y0 - self.yMin), (dy, self.yMax - y0)):
+   if p == 0:
+    if q < 0: return None
+   else:
+    t = q / p
+    if p < 0:
+     if t > t1: return None
+     elif t > t0: t0 = t
+    else:
+     if t < t0: return None
+     elif t < t1: t1 = t
+  return (x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy)
+
+
+# Zjednodušení čáry v pixelech před předáním plátnu. Ve sloupci pixelů se ponechá jen první,
+# nejnižší, nejvyšší a poslední bod (M4), opakované body se sloučí a body ležící přesně
+# na spojnici sousedů se vypustí - vykreslená čára je stejná, jen má mnohem méně souřadnic.
+class PolylineReducer(ComputingClass):
+ # points - plochý seznam [x1, y1, x2, y2...] celočíselných souřadnic
  @staticmethod
- def substLog(rec):
-  toSubst, hang = Function.preparePart(rec)
-  mainExpr = 'math.log(' + toSubst[3:].split('(', 1)[-1][:-1] + ', (' + toSubst[3:].split('(')[0] + '))'
-  return mainExpr + hang
+ def reduce(points):
+  if len(points) <= 4:
+   return points
+  return PolylineReducer.dropCollinear(PolylineReducer.reduceColumns(points))
  
- # Násobení .
  @staticmethod
- def substTiming(rec, aft):
-  toSubst = rec.group(0)
-  return '(' + toSubst.split(aft, 1)[0] + ')*' + aft
+ def reduceColumns(points):
+  reduced = []
+  i = 0
+  n = len(points)
+  while i < n:
+   x = points[i]
+   first = last = minY = maxY = points[i+1]
+   iMin = iMax = i
+   j = i + 2
+   while j < n and points[j] == x:
+    last = points[j+1]
+    if last < minY:
+     minY, iMin = last, j
+    elif last > maxY:
+     maxY, iMax = last, j
+    j += 2
+   if iMin < iMax:
+    column = (first, minY, maxY, last)
+   else:
+    column = (first, maxY, minY, last)
+   prev = None
+   for y in column:
+    if y != prev:
+     reduced.append(x)
+     reduced.append(y)
+     prev = y
+   i = j
+  return reduced
  
- # Násobení .
  @staticmethod
- def substAbsOverflow(rec):
-  toSubst = rec.group(0)
-  return toSubst[:-2] + toSubst[-1]
- 
- # Slovníky určující substituce předpisu pro výpočet.
- EXPR_SUBPATT = [',',  'X', 'x',   'A', 'a',   'B', 'b',   'C', 'c',   'D', 'd',   'sin',      '(c)os',    't(a)n',    '(c)o', 'tg',       ')(',  ')|',  ')[',  'log(',   'ln',       'sqrt',  'pi',      'e',      '(a)r(c)math.', 'sgn',        '(a)*(b)s']
- EXPR_SUBSUBST = ['.', 'x', '(x)', 'a', '(a)', 'b', '(b)', 'c', '(c)', 'd', '(d)', 'math.sin', 'math.cos', 'math.tan', '1/',   'math.tan', ')*(', ')*|', ')*[', 'log10(', 'math.log', 'root2', 'math.pi', 'math.e', 'math.a',       'mathfx.sgn', 'abs']
- EXPR_REGPATT = [r'log\([0-9xabcd.]+\)\*\(', r'root\([0-9xabcd.]+\)\*\(', r'log[0-9xabcd.]+\(.+\)', r'root[0-9xabcd.]+\(.+\)', r'[0-9.]+\(', r'[0-9xabcd.]+\|', r'\|.+?\*\|', r'[0-9xabcd.]+\[', r'\|.+?\|', r'\[.+?\]']
- EXPR_REGFUNC = [(lambda x: 'log' + x.group(0)[4:-3] + '('),
-   (lambda x: 'root' + x.group(0)[5:-3] + '('),
-   lambda x: Function.substLog(x), # meni log2(3) na math.log(3, 2) - NETBU (Not Expected To Be Understood)
-   lambda x: Function.substRoot(x), # meni root3(5) na (5)**(1/3) - NETBU
-   lambda x: Function.substTiming(x, '('), # meni 2.5(...) na (2.5)*(...)
-   lambda x: Function.substTiming(x, '|'), # meni 2.5|...| na (2.5)*|...|
-   lambda x: Function.substAbsOverflow(x), # meni |...*| na |...|
-   lambda x: Function.substTiming(x, '['), # meni 2.5[...] na (2.5)*[...]
-   (lambda x: 'abs(' + x.group(0)[1:-1] + ')'), # nahrazeni |2x| za abs(2x) - NA KONEC!
-   (lambda x: 'int(' + x.group(0)[1:-1] + ')')] # nahrazeni [x] za int(x)
- PARS = ['a', 'b', 'c', 'd']
+ def dropCollinear(points):
+  reduced = points[:2]
+  for i in range(2, len(points) - 2, 2):
+   x0, y0 = reduced[-2], reduced[-1]
+   x1, y1, x2, y2 = points[i:i+4]
+   # ponechat, pokud bod neleží na spojnici, nebo se na ní čára vrací zpět
+   if (x1 - x0) * (y2 - y0) != (x2 - x0) * (y1 - y0) or (x1 - x0) * (x2 - x1) + (y1 - y0) * (y2 - y1) < 0:
+    reduced.append(x1)
+    reduced.append(y1)
+  reduced.extend(points[-2:])
+  return reduced
+
+
+# Vektorový výpočet funkcí - předpis se vyhodnotí pro celou mřížku x najednou.
+# Nedefinované a komplexní hodnoty se maskují jako NaN a vrací se jako None.
+class ArrayBackend(ComputingClass):
+ name = 'ARRAY'
+ namespace = None
+ # funkce modulu math, které se v NumPy jmenují jinak
+ MATH_SUBST = {'asin' : 'arcsin', 'acos' : 'arccos', 'atan' : 'arctan', 'atan2' : 'arctan2',
+  'asinh' : 'arcsinh', 'acosh' : 'arccosh', 'atanh' : 'arctanh', 'pow' : 'power'}
+ 
+ @staticmethod
+ def isAvailable():
+  return numpy is not None and bool(conf.get('gridpar', 'numpy-backend'))
+ 
+ # Vrací z kódu předpisu (ExprCompiler.getBinder) vektorovou funkci bind, nebo None,
+ # pokud NumPy není k dispozici.
+ @staticmethod
+ def compileBinder(code):
+  if numpy is None:
+   return None
+  return ExprCompiler.compile(code, ArrayBackend.getNamespace())['bind']
+ 
+ @staticmethod
+ def bind(bind, par):
+  with numpy.errstate(all='ignore'):
+   return bind(**par)
+ 
+ # Vyhodnocuje funkci pro seznam bodů, vrací seznam hodnot (None pro nedefinované).
+ @staticmethod
+ def getValues(function, xs):
+  xArr = numpy.asarray(xs, dtype=float)
+  with numpy.errstate(all='ignore'):
+   res = numpy.asarray(function(xArr))
+   if numpy.iscomplexobj(res):
+    res = numpy.where(res.imag == 0, res.real, numpy.nan)
+   res = numpy.broadcast_to(res.astype(float), xArr.shape)
+   undefined = ~numpy.isfinite(res)
+  ys = res.tolist()
+  for i in numpy.flatnonzero(undefined).tolist():
+   ys[i] = None
+  return ys
+ 
+ # Sestavuje jmenný prostor, ve kterém math a mathfx ukazují na funkce NumPy.
+ @staticmethod
+ def getNamespace():
+  if ArrayBackend.namespace is None:
+   arrayMath = types.SimpleNamespace(log=ArrayBackend.log)
+   for name in dir(math):
+    if name.startswith('_') or hasattr(arrayMath, name): continue
+    value = getattr(math, name)
+    if not callable(value):
+     setattr(arrayMath, name, value) # konstanty (pi, e...)
+    elif hasattr(numpy, ArrayBackend.MATH_SUBST.get(name, name)):
+     setattr(arrayMath, name, getattr(numpy, ArrayBackend.MATH_SUBST.get(name, name)))
+   ArrayBackend.namespace = {'math' : arrayMath, 'mathfx' : types.SimpleNamespace(sgn=numpy.sign),
+    'abs' : numpy.abs, 'int' : numpy.trunc}
+  return ArrayBackend.namespace
+ 
+ # math.log s nepovinným základem (log2(x) se přepisuje na math.log(x, 2))
+ @staticmethod
+ def log(x, base=None):
+  if base is None:
+   return numpy.log(x)
+  else:
+   return numpy.log(x) / numpy.log(base)
 
   
 class PlotComputer(ComputingClass):
@@ -544,6 +2126,11 @@ class PlotComputer(ComputingClass):
  # Pozice středu - myší po ploše, nutno plynule - WZERO
  #
 
+ # Stupně přepočtu funkcí po změně (viz getChangeStage)
+ STAGE_STYLE = 1   # jen barva/tloušťka čáry
+ STAGE_PROJECT = 2 # nový převod vzorků na pixely (osa y, svislý posun, výška plátna)
+ STAGE_SAMPLE = 3  # nové vzorky (rozsah nebo měřítko osy x)
+
  def __init__(self):
   # Inicializace hodnot
   self.wVal = 0
@@ -554,6 +2141,7 @@ class PlotComputer(ComputingClass):
   self.zoneSpace = 0
   # Stavové proměnné počítání
   self.xPiScale = False
+  self.xState = None
   # (Více/méně) konstanty rozměrů mřížky
   self.xCount2 = conf.get('gridpar', 'x-normal-count')*2
   self.xScale = conf.get('gridpar', 'default-scale')
@@ -871,10 +2459,21 @@ class PlotComputer(ComputingClass):
   self.yPlus = self.yZero / self.yUnitPx
  
  # Sjednocovač pro SPACES a RANGES (nikdy nejdou zvlášť) - a funkce jsou k nim prilepeny take
+ # (přepočtou se až při vykreslení, viz RenderScheduler)
  def countGrid(self):
   self.countSpaces()
   self.countRanges()
-  fman.countFunctions()
+  fman.invalidateFunctions(self.getChangeStage())
+ 
+ # Určuje, jak velký přepočet funkcí změna mřížky vyžaduje - nové vzorky jen tehdy,
+ # když se změnil rozsah nebo měřítko osy x, jinak stačí vzorky znovu převést na pixely.
+ def getChangeStage(self):
+  xState = (self.xUnitPx, self.xMinus, self.xPlus)
+  if xState != self.xState:
+   self.xState = xState
+   return PlotComputer.STAGE_SAMPLE
+  else:
+   return PlotComputer.STAGE_PROJECT
  
  
  #
@@ -974,6 +2573,15 @@ class PlotComputer(ComputingClass):
  def getYNum(self, yPx):
   return (self.yZero - yPx) / self.yUnitPx
  
+ def getXUnitPx(self):
+  return self.xUnitPx
+ 
+ def getView(self):
+  return PlotView(self)
+ 
+ def getYUnitPx(self):
+  return self.yUnitPx
+ 
  def getXPx(self, xNum):
   return int((xNum * self.xUnitPx) + self.xZero)
  
@@ -995,17 +2603,232 @@ class PlotComputer(ComputingClass):
  def getHStart(self):
   return self.hStart
  
+ # Vše, na čem závisí rozvržení mřížky (viz GridLayout)
+ def getGridState(self):
+  return (self.wVal, self.hVal, self.xZero, self.yZero, self.xAxis, self.yAxis, self.unit1, self.dim1, self.dim3,
+   self.xUnitPx, self.yUnitPx, self.wStart, self.hStart, self.xPiScale, self.getXPiQuot())
+ 
  def getDeadZones(self):
   return (bool(self.leftDeadZone), bool(self.rightDeadZone), bool(self.topDeadZone), bool(self.bottomDeadZone))
 
 
 
+# Snímek pohledu - rozsah a převod čísel na pixely. Funkce počítají s ním, ne se sdíleným
+# PlotComputerem, takže jejich výpočet může běžet i mimo hlavní vlákno.
+class PlotView(ComputingClass):
+ def __init__(self, computer):
+  self.xMinus = computer.getXMinus()
+  self.xPlus = computer.getXPlus()
+  self.yRange = computer.getYRange()
+  self.xUnitPx = computer.getXUnitPx()
+  self.yUnitPx = computer.getYUnitPx()
+  self.xZero = computer.getXZero()
+  self.yZero = computer.getYZero()
+  self.wVal = computer.getWVal()
+  self.hVal = computer.getHVal()
+ 
+ def getXPx(self, xNum):
+  return int((xNum * self.xUnitPx) + self.xZero)
+ 
+ def getYPx(self, yNum):
+  return int(self.yZero - (yNum * self.yUnitPx))
+
+
+# Plánovač vykreslování. Požadavky na překreslení (mřížky nebo jednotlivých funkcí)
+# a pohyb kurzoru jen sbírá a všechny, které přijdou během jednoho snímku, vyřídí jediným
+# průchodem v after_idle; průchody od sebe dělí nejméně frame-interval ms. Z pohybu
+# kurzoru se uplatní jen poslední poloha.
+class RenderScheduler(ComputingClass):
+ name = 'SCHED'
+ def __init__(self, render):
+  self.render = render
+  self.interval = conf.get('gridpar', 'frame-interval') / 1000
+  self.lastRender = 0
+  self.pending = None
+  self.grid = False
+  self.fids = {}
+  self.motion = None
+  self.suspended = False
+ 
+ # Transakce (načtení dokumentu) - požadavky se jen sbírají, vykreslí se najednou po resume
+ def suspend(self):
+  self.suspended = True
+ 
+ def resume(self):
+  self.suspended = False
+  if self.grid or self.fids or self.motion is not None:
+   self.schedule()
+ 
+ def requestGrid(self):
+  self.grid = True
+  self.schedule()
+ 
+ # stage - PlotComputer.STAGE_PROJECT pro překreslení, STAGE_STYLE jen pro změnu barvy/tloušťky
+ def requestFunction(self, fid, stage=None):
+  if stage is None:
+   stage = PlotComputer.STAGE_PROJECT
+  self.fids[fid] = max(self.fids.get(fid, 0), stage)
+  self.schedule()
+ 
+ def requestMotion(self, x, y):
+  self.motion = (x, y)
+  self.schedule()
+ 
+ # Zahodí ještě nevyřízený pohyb (kurzor opustil plátno, konec posunu)
+ def cancelMotion(self):
+  self.motion = None
+ 
+ def schedule(self):
+  if self.pending is None and not self.suspended:
+   wait = self.lastRender + self.interval - time.perf_counter()
+   if wait > 0:
+    self.pending = win.after(int(wait * 1000) + 1, self.run)
+   else:
+    self.pending = win.after_idle(self.run)
+ 
+ def run(self):
+  self.pending = None
+  self.lastRender = time.perf_counter()
+  grid, fids, motion = self.grid, self.fids, self.motion
+  self.grid = False
+  self.fids = {}
+  self.motion = None
+  self.render(grid, fids, motion)
+
+
+# Rozvržení mřížky - polohy čar, jejich styly a popisky pro aktuální pohled. Styly se
+# vyhodnotí z konfigurace jednou, rozvržení se přepočítá jen při změně pohledu
+# a popisky se pamatují podle čísla (tedy měřítka) a násobku pí.
+class GridLayout(ComputingClass):
+ # Konstanta PLOT - bitový ukazatel:
+ # 0 - nevyrábět vůbec
+ # 1 - malá čárka (Stroke)
+ # 2 - popisek (Label)
+ # 4 - velmi slabá čára (Line 1)
+ # 8 - slabší čára (Line 2)
+ # 16 - silnější čára (Line 3)
+ # 32 - silná čára (Line 4) - osy
+ # Přidání vlastnosti: PLOT |= vlastnost
+ # Odebrání vlastnosti: PLOT &= ~vlastnost
+ # Ověření vlastnosti: (PLOT & vlastnost) == vlastnost
+ MAX_LABELS = 4096
+ 
+ def __init__(self):
+  # styl čáry podle pořadí (osa, větší, normál, menší): (barva čáry, čárka, popisek)
+  self.axisStyle = self.getStyle(conf.get('gridpar', 'axis-grid-plot'))
+  self.majorStyle = self.getStyle(conf.get('gridpar', 'major-grid-plot'))
+  self.normalStyle = self.getStyle(conf.get('gridpar', 'normal-grid-plot'))
+  self.minorStyle = self.getStyle(conf.get('gridpar', 'minor-grid-plot'))
+  self.labelFormat = conf.get('out', 'grid-float-labelformat')
+  self.labels = {}
+  self.state = None
+  self.xMarks = []
+  self.yMarks = []
+ 
+ def getStyle(self, plot):
+  return (self.getLineColour(plot), (plot & 1) == 1, (plot & 2) == 2)
+ 
+ def getLineColour(self, plot):
+  if (plot & 4) == 4:
+   return conf.get('colour', 'grid-line-1')
+  elif (plot & 8) == 8:
+   return conf.get('colour', 'grid-line-2')
+  elif (plot & 16) == 16:
+   return conf.get('colour', 'grid-line-3')
+  elif (plot & 32) == 32:
+   return conf.get('colour', 'grid-line-4')
+  else:
+   return None
+ 
+ # Značky čar v x-směru (konstanty, popisky na ose y): (pozice, barva čáry, čárka, popisek)
+ def getXMarks(self):
+  self.update()
+  return self.xMarks
+ 
+ # Značky čar v y-směru (popisky na ose x)
+ def getYMarks(self):
+  self.update()
+  return self.yMarks
+ 
+ def update(self):
+  state = comp.getGridState()
+  if state != self.state:
+   self.state = state
+   self.xMarks = self.countMarks(comp.getHStart(), comp.getHVal(), comp.getXAxisOrd(), self.getYLabel)
+   self.yMarks = self.countMarks(comp.getWStart(), comp.getWVal(), comp.getYAxisOrd(), self.getXLabel)
+ 
+ def countMarks(self, start, end, axisOrd, getLabel):
+  marks = []
+  unit = comp.getMinorUnit()
+  normalPeriod = comp.getMinorDim()
+  majorPeriod = comp.getMinorDim() * comp.getMajorDim()
+  i = 0
+  coor = start
+  while coor <= end:
+   if i == axisOrd:
+    lineColour, stroke, label = self.axisStyle
+   elif (i - axisOrd) % majorPeriod == 0:
+    lineColour, stroke, label = self.majorStyle
+   elif (i - axisOrd) % normalPeriod == 0:
+    lineColour, stroke, label = self.normalStyle
+   else:
+    lineColour, stroke, label = self.minorStyle
+   marks.append((coor, lineColour, stroke, (getLabel(coor) if label else None)))
+   coor += unit
+   i += 1
+  return marks
+ 
+ # Popisky os
+ # Osa X
+ def getXLabel(self, coor):
+  if comp.getPiScale():
+   key = (comp.getXPiMult(coor), comp.getXPiQuot())
+   if key not in self.labels:
+    self.remember(key, comp.getPiLabel(coor))
+   return self.labels[key]
+  else:
+   return self.getNumLabel(comp.getXNum(coor))
+ 
+ # Osa Y
+ def getYLabel(self, coor):
+  return self.getNumLabel(comp.getYNum(coor))
+ 
+ def getNumLabel(self, number):
+  if number not in self.labels:
+   if int(number) == number:
+    self.remember(number, str(int(number)))
+   else:
+    self.remember(number, self.labelFormat.format(number))
+  return self.labels[number]
+ 
+ def remember(self, key, label):
+  if len(self.labels) >= GridLayout.MAX_LABELS:
+   self.labels.clear()
+  self.labels[key] = label
+
+
 class Manager(ComputingClass):
  def __init__(self):
+  self.scheduler = RenderScheduler(self.render)
+  self.layout = GridLayout()
+  self.refineTimer = None
+  self.lastChange = 0
+  if conf.get('gridpar', 'evaluation-guard'):
+   self.evaluation = GuardedEvaluationPool(max(1, conf.get('gridpar', 'evaluation-threads')), self.samplesReady)
+  elif conf.get('gridpar', 'evaluation-processes'):
+   self.evaluation = ProcessEvaluationPool(conf.get('gridpar', 'evaluation-processes'), self.samplesReady)
+  elif conf.get('gridpar', 'evaluation-threads'):
+   self.evaluation = EvaluationPool(conf.get('gridpar', 'evaluation-threads'), self.samplesReady)
+  else:
+   self.evaluation = None
   # Stavové proměnné pohybu
   self.scrolling = False
   self.motionLines = False
+  self.hover = False
   self.scrollBegin = (0, 0)
+  self.panOffset = (0, 0)
+  self.heldGrid = False # redraws requested during a live pan (see render)
+  self.heldFunctions = {}
 
  #
  # Event Handlers
@@ -1018,7 +2841,7 @@ class Manager(ComputingClass):
  
  # Zmena polohy kurzoru na platne (pro zobrazeni polohy)
  def cursorMoved(self, x, y):
-  self.motion(x, y)
+  self.scheduler.requestMotion(x, y)
 
  # Posun kurzoru mimo platno (konec zobrazovani polohy)
  def motionEnd(self):
@@ -1168,12 +2991,20 @@ class Manager(ComputingClass):
   comp.firstCount()
   self.replot()
  
+ # Load transaction - drop the old functions first (their pending evaluation included), then apply
+ # the grid and the new functions with redraw and subtree sharing suspended, then a single pass
  def loadData(self, imp):
-  comp.fileReset(imp)
-  self.deleteAllFunctions()
-  flist = imp.getFunctionList()
-  for fid in flist.keys():
-   self.loadFunction(fid, *flist[fid])
+  self.scheduler.suspend()
+  fman.suspendSharing()
+  try:
+   self.deleteAllFunctions()
+   comp.fileReset(imp)
+   flist = imp.getFunctionList()
+   for fid in flist.keys():
+    self.loadFunction(fid, *flist[fid])
+  finally:
+   fman.resumeSharing()
+   self.scheduler.resume()
   self.replot()
  
  # Cursor motion - update motion indicators (and scroll, if scrolling)
@@ -1182,33 +3013,67 @@ class Manager(ComputingClass):
    self.plotMotionLines(x, y)
   panel.motion(comp.getXNum(x), comp.getYNum(y), self.scrolling)
   if self.scrolling:
-   self.plotScrollLines((comp.getXZero() + x - self.scrollBegin[0]), (comp.getYZero() + y - self.scrollBegin[1]))
+   self.pan(x - self.scrollBegin[0], y - self.scrollBegin[1])
+  elif self.hover:
+   panel.hover(*self.getHoverValue(x, y))
+
+ # Value of the selected function (or of the curve nearest to the cursor) at cursor x - (fid, value)
+ def getHoverValue(self, x, y):
+  fid = fman.getSelectedFID()
+  if fid is None:
+   nearest = plot.getNearestFunction(x, y, conf.get('gridpar', 'hover-area'))
+   if nearest is None:
+    return (None, None)
+   fid = nearest[0]
+  return (fid, fman.getFunction(fid).getValueAt(comp.getXNum(x)))
 
  # Cursor out of canvas - erase motion indicators
  def endMotion(self):
+  self.scheduler.cancelMotion()
   plot.eraseMotionLines()
   panel.motionEnd()
+  panel.hover(None, None)
  
  # Click and hold - scroll started, save start position and display movement (dx, dy)
  def startScroll(self, x, y):
   self.scrolling = True
   panel.scrollStart(comp.getXNum(x), comp.getYNum(y))
+  panel.hover(None, None)
   self.scrollBegin = (x, y)
+  self.panOffset = (0, 0)
  
- # Left button released - scroll ended, delete trackers and update grid
+ # Scrolling - move what is plotted and preview the exposed margin (full recount on release)
+ def pan(self, xOff, yOff):
+  plot.panBy(xOff - self.panOffset[0], yOff - self.panOffset[1])
+  self.panOffset = (xOff, yOff)
+  self.plotPanPreview(xOff, yOff)
+ 
+ # Left button released - scroll ended, delete previews and update grid
  def endScroll(self, x, y):
+  self.scheduler.cancelMotion()
   panel.scrollEnd()
+  plot.erasePreview()
+  self.scrolling = False
+  self.releaseRedraw()
+  self.lastChange = time.perf_counter()
+  self.updateStatus()
+  if (x, y) == self.scrollBegin:
+   # back at the start - the dropped motion frame would have moved the items back, undo the pan
+   if self.panOffset != (0, 0):
+    plot.panBy(-self.panOffset[0], -self.panOffset[1])
+   self.panOffset = (0, 0)
+   return
+  self.panOffset = (0, 0)
   comp.zeroXAdd(x - self.scrollBegin[0])
   comp.zeroYAdd(y - self.scrollBegin[1])
   comp.scrollCount()
   self.replot()
-  self.scrolling = False
  
  # Create function (panel or program start command)
  def createFunction(self, expr):
   fid = fman.createFunction(expr)
   panel.addFunction(fid)
-  self.plotFunction(fid)
+  self.replotFunction(fid)
 
  def editFunction(self, fid, expr):
   fman.editFunction(fid, expr)
@@ -1220,9 +3085,9 @@ class Manager(ComputingClass):
   oldFID = fman.getSelectedFID()
   fman.selectFunction(fid)
   panel.selectFunction(fid)
-  self.replotFunction(fid)
+  self.restyleFunction(fid)
   if oldFID:
-   self.replotFunction(oldFID)
+   self.restyleFunction(oldFID)
  
  def loadFunction(self, fid, number, exprSrc, exprFin):
   fman.loadFunction(fid, number, exprSrc, exprFin)
@@ -1233,7 +3098,7 @@ class Manager(ComputingClass):
   fid = fman.verifyFID()
   if fid is not None:
    fman.unselectFunction(fid)
-   self.replotFunction(fid)
+   self.restyleFunction(fid)
    panel.unselectFunction()
  
  # Change function color
@@ -1243,10 +3108,12 @@ class Manager(ComputingClass):
    if fid is None:
     fid = fman.getSelectedFID()
    fman.changeFuncColor(color, fid)
-   self.replotFunction(fid)
+   self.restyleFunction(fid)
 
  # Delete function after all
  def deleteFunction(self, fid):
+  if self.evaluation is not None:
+   self.evaluation.cancel(fid) # a new function may get the same fid
   fman.deleteFunction(fid)
   self.eraseFunction(fid)
   panel.removeFunction(fid)
@@ -1264,28 +3131,137 @@ class Manager(ComputingClass):
  # Switch motion lines appearance (panel checkbox)
  def switchMotionLines(self):
   self.motionLines = not self.motionLines
+  if not self.motionLines:
+   plot.eraseMotionLines()
+
+ # Switch hover readout of function value (panel checkbox)
+ def switchHover(self):
+  self.hover = not self.hover
+  if not self.hover:
+   panel.hover(None, None)
  
- # Main updater...
+ # Main updater... (only plans the redraw, it is done in render)
  def replot(self):
-  self.replotGrid()
-  self.plotFunctions()
+  self.scheduler.requestGrid()
+ 
+ # Scheduled redraw - count what needs it, then replot the grid (and so all functions) or just the given ones,
+ # functions with only a style change get just restyled
+ def render(self, grid, fids, motion=None):
+  if self.scrolling:
+   # live pan only moves the drawn items and comp still has the pre-drag view - redraw after endScroll
+   self.holdRedraw(grid, fids)
+   grid, fids = False, {}
+  else:
+   fman.countFunctions(comp.getView(), self.evaluation)
+  if grid:
+   self.replotGrid()
+   self.plotFunctions()
+  else:
+   for fid, stage in fids.items():
+    if fid not in fman.getFunctionIds():
+     continue
+    elif stage >= PlotComputer.STAGE_PROJECT:
+     self.plotFunction(fid)
+    else:
+     self.styleFunction(fid)
+  if grid or fids:
+   self.lastChange = time.perf_counter()
+   self.updateStatus()
+  if motion is not None:
+   self.motion(*motion)
+
+ def holdRedraw(self, grid, fids):
+  self.heldGrid = self.heldGrid or grid
+  for fid, stage in fids.items():
+   self.heldFunctions[fid] = max(self.heldFunctions.get(fid, 0), stage)
+ 
+ # Request the redraws held during a live pan
+ def releaseRedraw(self):
+  grid, fids = self.heldGrid, self.heldFunctions
+  self.heldGrid = False
+  self.heldFunctions = {}
+  if grid:
+   self.replot()
+  for fid, stage in fids.items():
+   self.scheduler.requestFunction(fid, stage)
+ 
+ # Report stopped functions and functions shown at reduced resolution, plan their refinement
+ def updateStatus(self):
+  functions = [fman.getFunction(fid) for fid in fman.getFunctionIds()]
+  failed = [str(function.getNumber()) for function in functions if function.isFailed()]
+  reduced = [str(function.getNumber()) for function in functions if function.isReduced()]
+  if failed:
+   win.status.change(conf.get('out', 'status-failed').format(', '.join(failed)))
+  elif reduced:
+   win.status.change(conf.get('out', 'status-reduced').format(', '.join(reduced)))
+  else:
+   win.status.rollback()
+  if self.refineTimer is None and any(function.needsRefine() for function in functions):
+   self.refineTimer = win.after(conf.get('gridpar', 'refine-delay'), self.refineFunctions)
+
+ # Refine reduced functions to full resolution once nothing was redrawn for refine-delay ms
+ # (not during a live pan - endScroll plans them again)
+ def refineFunctions(self):
+  if self.scrolling:
+   self.refineTimer = None
+   return
+  delay = conf.get('gridpar', 'refine-delay')
+  idle = (time.perf_counter() - self.lastChange) * 1000
+  if idle < delay:
+   self.refineTimer = win.after(int(delay - idle) + 1, self.refineFunctions)
+   return
+  self.refineTimer = None
+  for fid in fman.getFunctionIds():
+   function = fman.getFunction(fid)
+   if function.needsRefine():
+    function.refine()
+    self.replotFunction(fid)
  
  
  #
  # Grid Plotting
  #
  
+ # (canvas items are reused, see CanvasItemPool)
  def replotGrid(self):
-  self.eraseGrid()
+  plot.beginGrid()
   self.plotGrid()
+  plot.endGrid()
  
  def plotFunctions(self):
   for fid in fman.getFunctionIds():
    self.plotFunction(fid)
  
  def replotFunction(self, fid):
-  self.eraseFunction(fid)
-  self.plotFunction(fid)
+  self.scheduler.requestFunction(fid)
+
+ # Samples counted in background arrived - replot the function (stale ones are dropped)
+ def samplesReady(self, job):
+  if job.fid not in fman.getFunctionIds():
+   return
+  function = fman.getFunction(job.fid)
+  if job.error is not None and job.generation != function.generation:
+   return # stale job (the function was edited meanwhile)
+  if isinstance(job.error, EvaluationGuardError):
+   self.log('function {0} stopped: {1}'.format(function.getNumber(), job.error))
+   function.fail(str(job.error))
+   self.replotFunction(job.fid)
+   return
+  elif job.error is not None:
+   function.deleteSelf()
+   raise job.error
+  if function.applySamples(job):
+   self.replotFunction(job.fid)
+
+ # Stop background evaluation (program exit)
+ def shutdown(self):
+  if self.evaluation is not None:
+   self.evaluation.shutdown()
+  self.log('evaluator cache: {0} hits, {1} misses, {2} compiled'.format(*fman.evaluators.getStats()))
+ 
+ # Only colour or line width changed
+ def restyleFunction(self, fid):
+  self.scheduler.requestFunction(fid, PlotComputer.STAGE_STYLE)
 
  # zrobi mrizku podle aktualnich parametru (nepocita nic)
  def plotGrid(self):
@@ -1293,24 +3269,26 @@ class Manager(ComputingClass):
   self.plotXGrid()
   self.plotYGrid()
 
+ # Čáry a popisky os (rozvržení viz GridLayout)
  def plotXGrid(self):
   # vytvari cary v x-smeru (tedy konstanty, lisici se y-souradnici)
-  self.plotDirGrid(comp.getHStart(), comp.getHVal(), self.plotXGridMark)
+  for coor, lineColour, stroke, label in self.layout.getXMarks():
+   if lineColour is not None:
+    plot.plotXGridLine(coor, lineColour)
+   if stroke:
+    plot.plotXGridStroke(coor)
+   if label is not None:
+    plot.plotYGridLabel(y=coor, text=label)
     
  def plotYGrid(self):
   # vytvari cary v y-smeru (tedy nefunkce, lisici se x-souradnici)
-  self.plotDirGrid(comp.getWStart(), comp.getWVal(), self.plotYGridMark)
- 
- def plotDirGrid(self, start, end, plotFunc):
-  i = 0
-  coor = start
-  while coor <= end:
-   plotFunc(coor, i)
-   coor += comp.getMinorUnit()
-   i += 1
-  
- def eraseGrid(self):
-  plot.eraseGrid()
+  for coor, lineColour, stroke, label in self.layout.getYMarks():
+   if lineColour is not None:
+    plot.plotYGridLine(coor, lineColour)
+   if stroke:
+    plot.plotYGridStroke(coor)
+   if label is not None:
+    plot.plotXGridLabel(x=coor, text=label)
    
    
  def plotDeadZones(self):
@@ -1332,104 +3310,39 @@ class Manager(ComputingClass):
    plot.plotWDeadZoneLine()
  
  
- # Upper Plot Commands (Still some computing involved...)
- # Čáry a popisky os
- def plotXGridMark(self, coor, i):
-  plotState = self.getGridMarkType(i, comp.getXAxisOrd())
-  lineColour = self.getLineColour(plotState)
-  if lineColour is not None:
-   plot.plotXGridLine(coor, lineColour)
-  if (plotState & 1) == 1:
-   plot.plotXGridStroke(coor)
-  if (plotState & 2) == 2:
-   self.plotYLabel(coor)
-
- def plotYGridMark(self, coor, i):
-  plotState = self.getGridMarkType(i, comp.getYAxisOrd())
-  lineColour = self.getLineColour(plotState)
-  if lineColour is not None:
-   plot.plotYGridLine(coor, lineColour)
-  if (plotState & 1) == 1:
-   plot.plotYGridStroke(coor)
-  if (plotState & 2) == 2:
-   self.plotXLabel(coor)
- 
- # vybira barvu cary podle poradi (osa, vetsi, normal, mensi)
- def getGridMarkType(self, i, axisOrd):
-  # Konstanta PLOT - bitový ukazatel:
-  # 0 - nevyrábět vůbec
-  # 1 - malá čárka (Stroke)
-  # 2 - popisek (Label)
-  # 4 - velmi slabá čára (Line 1)
-  # 8 - slabší čára (Line 2)
-  # 16 - silnější čára (Line 3)
-  # 32 - silná čára (Line 4) - osy
-  # Přidání vlastnosti: PLOT |= vlastnost
-  # Odebrání vlastnosti: PLOT &= ~vlastnost
-  # Ověření vlastnosti: (PLOT & vlastnost) == vlastnost
-  if i == axisOrd:
-   return conf.get('gridpar', 'axis-grid-plot')
-  elif (i - axisOrd) % (comp.getMinorDim() * comp.getMajorDim()) == 0:
-   return conf.get('gridpar', 'major-grid-plot')
-  elif (i - axisOrd) % comp.getMinorDim() == 0:
-   return conf.get('gridpar', 'normal-grid-plot')
-  else:
-   return conf.get('gridpar', 'minor-grid-plot')
- 
- def getLineColour(self, plot):
-  if (plot & 4) == 4:
-   return conf.get('colour', 'grid-line-1')
-  elif (plot & 8) == 8:
-   return conf.get('colour', 'grid-line-2')
-  elif (plot & 16) == 16:
-   return conf.get('colour', 'grid-line-3')
-  elif (plot & 32) == 32:
-   return conf.get('colour', 'grid-line-4')
-  else:
-   return None
-  
- # Popisky os
- # Osa X
- def plotXLabel(self, coor):
-  if comp.getPiScale():
-   label = comp.getPiLabel(coor)
-  else:
-   number = comp.getXNum(coor)
-   if int(number) == number:
-    label = str(int(number))
-   else:
-    label = conf.get('out', 'grid-float-labelformat').format(number)
-  plot.plotXGridLabel(x=coor, text=label)
- 
- # Osa Y
- def plotYLabel(self, coor):
-  number = comp.getYNum(coor)
-  if int(number) == number:
-   label = str(int(number))
-  else:
-   label = conf.get('out', 'grid-float-labelformat').format(number)
-  plot.plotYGridLabel(y=coor, text=label)
-
-
  # Funkce
  def plotFunction(self, fid):
   function = fman.getFunction(fid)
   pointsList = function.getPoints()
+  plot.beginFunction(fid)
   for points in pointsList:
    if len(points) < 4: continue
    plot.plotFunctionLine(points, colour=function.getColour(), lineWidth=function.getLineWidth(), fid=function.getFID())
+  plot.endFunction(fid)
 
- # Čáry posunu souřadnic
- def plotScrollLines(self, x, y):
-  plot.eraseScrollLines()
-  plot.plotXScrollLine(y)
-  plot.plotYScrollLine(x)
+ def styleFunction(self, fid):
+  function = fman.getFunction(fid)
+  plot.restyleFunction(fid, colour=function.getColour(), lineWidth=function.getLineWidth())
+
+ # Náhled funkcí v pruhu odkrytém posunem
+ def plotPanPreview(self, xOff, yOff):
+  plot.erasePreview()
+  if xOff > 0:
+   low, high = comp.getXNum(-xOff), comp.getXNum(0)
+  elif xOff < 0:
+   low, high = comp.getXNum(comp.getWVal()), comp.getXNum(comp.getWVal() - xOff)
+  else:
+   return
+  view = comp.getView()
+  for fid in fman.getFunctionIds():
+   function = fman.getFunction(fid)
+   for points in function.getPreviewPoints(low, high, view, xOff, yOff):
+    if len(points) < 4: continue
+    plot.plotPreviewLine(points, colour=function.getColour(), lineWidth=function.getLineWidth())
  
  # Čáry posunu kurzoru
  def plotMotionLines(self, x, y):
-  plot.eraseMotionLines()
-  plot.plotXMotionLine(y)
-  plot.plotYMotionLine(x)
+  plot.plotMotionLines(x, y)
 
 
  # Mrtvé zóny (místa za osou, která je vlastně někde úplně jinde ;-))
@@ -1495,6 +3408,7 @@ class MainWindow(OutputClass, tk.Frame):
   plot = Plotter(self.leftFrame)
   panel = ControlPanel(self.rightFrame)
   self.menu = MainMenu(self.winfo_toplevel())
+  self.status = StatusBar(self.bottomFrame, conf.get('out', 'statusbar-default'))
  
  # Obrazky na tlacitka
  def loadImages(self):
@@ -1515,7 +3429,7 @@ class MainWindow(OutputClass, tk.Frame):
   # self.toolFrame.pack(side='top', fill='x')
   self.canvasFrame.pack(side='top', fill='x')
   self.rightFrame.pack(side='left', fill='y')
-  # self.status.display()
+  self.status.display()
   self.menu.display()
  
  def setTitle(self, title):
@@ -1532,12 +3446,156 @@ class MainWindow(OutputClass, tk.Frame):
  
   
 
+# Skupina prvků plátna jedné role (čáry mřížky, popisky, úseky jedné funkce...). Při překreslení
+# se prvky nemažou, ale jen přesunou (coords) a přenastaví (itemconfigure, jen co se změnilo);
+# vytvářejí se a mažou, jen když se změní jejich počet. Tagy dostávají rovnou při vytvoření.
+class CanvasItemPool(OutputClass):
+ def __init__(self, canvas, kind, tags):
+  self.canvas = canvas
+  self.create = getattr(canvas, 'create_' + kind)
+  self.tags = tags
+  self.items = [] # [id, souřadnice, volby]
+  self.used = 0
+  self.grown = False
+ 
+ def begin(self):
+  self.used = 0
+  self.grown = False
+ 
+ def place(self, coords, **options):
+  if self.used < len(self.items):
+   item = self.items[self.used]
+   if item[1] != coords:
+    self.canvas.coords(item[0], *coords)
+    item[1] = coords
+   changed = {key : value for key, value in options.items() if item[2].get(key) != value}
+   if changed:
+    self.canvas.itemconfigure(item[0], **changed)
+    item[2].update(changed)
+  else:
+   self.items.append([self.create(*coords, tags=self.tags, **options), coords, options])
+   self.grown = True
+  self.used += 1
+ 
+ # Maže prvky, které při posledním překreslení zbyly
+ def end(self):
+  if self.used < len(self.items):
+   self.canvas.delete(*[item[0] for item in self.items[self.used:]])
+   del self.items[self.used:]
+ 
+ def clear(self):
+  self.begin()
+  self.end()
+ 
+ def isGrown(self):
+  return self.grown
+ 
+ # Změna vzhledu všech prvků najednou (jeden příkaz přes společný tag)
+ def restyle(self, tag, **options):
+  self.canvas.itemconfigure(tag, **options)
+  for item in self.items:
+   item[2].update(options)
+ 
+ # Prvky byly posunuty mimo zásobník (Canvas.move) - uložené souřadnice neplatí
+ def forgetCoords(self):
+  for item in self.items:
+   item[1] = None
+
+
+# Prostorový index úseků křivek na plátně (rovnoměrná mřížka buněk) - hledání funkce pod
+# kurzorem bez dotazů do Tcl. Úseky se ukládají v souřadnicích bez posunu (offset), posun
+# plátna (Canvas.move) se tak do indexu promítne jen změnou offsetu.
+class SegmentIndex(OutputClass):
+ def __init__(self, cellSize):
+  self.cellSize = cellSize
+  self.cells = {} # (sloupec, řádek) -> {fid : [(x0, y0, x1, y1)...]}
+  self.fidCells = {} # fid -> množina buněk
+  self.halfWidths = {} # fid -> polovina tloušťky čáry
+  self.offset = (0, 0)
+ 
+ def add(self, fid, points, lineWidth):
+  self.setWidth(fid, lineWidth)
+  ox, oy = self.offset
+  keys = self.fidCells.setdefault(fid, set())
+  size = self.cellSize
+  for i in range(0, len(points) - 2, 2):
+   x0, y0, x1, y1 = points[i] - ox, points[i+1] - oy, points[i+2] - ox, points[i+3] - oy
+   segment = (x0, y0, x1, y1)
+   for col in range(int(min(x0, x1) // size), int(max(x0, x1) // size) + 1):
+    for row in range(int(min(y0, y1) // size), int(max(y0, y1) // size) + 1):
+     key = (col, row)
+     self.cells.setdefault(key, {}).setdefault(fid, []).append(segment)
+     keys.add(key)
+ 
+ def remove(self, fid):
+  for key in self.fidCells.pop(fid, ()):
+   cell = self.cells[key]
+   del cell[fid]
+   if not cell:
+    del self.cells[key]
+  self.halfWidths.pop(fid, None)
+ 
+ def setWidth(self, fid, lineWidth):
+  self.halfWidths[fid] = lineWidth / 2
+ 
+ def move(self, dx, dy):
+  self.offset = (self.offset[0] + dx, self.offset[1] + dy)
+ 
+ # Nejbližší funkce v okruhu radius od okraje čáry: (fid, vzdálenost), nebo None
+ def nearest(self, x, y, radius):
+  x -= self.offset[0]
+  y -= self.offset[1]
+  size = self.cellSize
+  best = None
+  for col in range(int((x - radius) // size), int((x + radius) // size) + 1):
+   for row in range(int((y - radius) // size), int((y + radius) // size) + 1):
+    for fid, segments in self.cells.get((col, row), {}).items():
+     for segment in segments:
+      dist = max(0, SegmentIndex.getDistance(x, y, *segment) - self.halfWidths[fid])
+      if dist <= radius and (best is None or dist < best[1]):
+       best = (fid, dist)
+  return best
+ 
+ # Vzdálenost bodu od úsečky
+ @staticmethod
+ def getDistance(x, y, x0, y0, x1, y1):
+  dx = x1 - x0
+  dy = y1 - y0
+  length = dx * dx + dy * dy
+  if length:
+   t = max(0, min(1, ((x - x0) * dx + (y - y0) * dy) / length))
+   x0 += t * dx
+   y0 += t * dy
+  return math.hypot(x - x0, y - y0)
+
+
 class Plotter(OutputClass, tk.Canvas):
+ # Skupiny prvků mřížky: role -> (druh prvku, tagy)
+ GRID_POOLS = {'dead-zone-rect' : ('rectangle', ('grid', 'dead-zone', 'dead-zone-rect')),
+  'dead-zone-line' : ('line', ('grid', 'dead-zone')),
+  'grid-x' : ('line', ('grid', 'grid-x')),
+  'grid-y' : ('line', ('grid', 'grid-y')),
+  'stroke-x' : ('line', ('grid', 'grid-x')),
+  'stroke-y' : ('line', ('grid', 'grid-y')),
+  'label-x' : ('text', ('grid', 'grid-label', 'grid-label-x')),
+  'label-y' : ('text', ('grid', 'grid-label', 'grid-label-y'))}
+
  def __init__(self, master):
   self.master = master
   tk.Canvas.__init__(self, self.master, borderwidth=1,
    background=conf.get('colour', 'canvas-background'), relief='groove')
   self.clickArea = conf.get('gridpar', 'click-area')
+  self.axisColour = conf.get('colour', 'grid-line-4')
+  self.deadZoneColour = conf.get('colour', 'dead-zone')
+  self.labelCloser = conf.get('gridpar', 'graphlabel-closer')
+  self.labelAnchor = conf.get('gridpar', 'graphlabel-anchor')
+  self.pools = {}
+  for role, (kind, tags) in Plotter.GRID_POOLS.items():
+   self.pools[role] = CanvasItemPool(self, kind, tags)
+  self.funcPools = {}
+  self.motionItems = None
+  self.motionShown = False
+  self.index = SegmentIndex(conf.get('gridpar', 'index-cell'))
   self.bindEvents()
  
  # Zobrazeni
@@ -1593,17 +3651,15 @@ class Plotter(OutputClass, tk.Canvas):
  
  # Handler Help (primo vazane udalostni metody)
  def getFunctionByPlace(self, x, y):
-  objList = self.find_overlapping(x - self.clickArea, y - self.clickArea, x + self.clickArea, y + self.clickArea)
-  funcs = self.find_withtag('func')
-  fid = None
-  for i in objList: # vybere funkci
-   if i in funcs:
-    fid = i
-    break
-  if fid is None: return
-  for tag in self.gettags(fid):
-   if 'func-' in tag:
-    return int(tag[5:])
+  nearest = self.getNearestFunction(x, y)
+  if nearest is not None:
+   return nearest[0]
+ 
+ # Nejbližší křivka v dosahu (výchozí je dosah kliknutí): (fid, vzdálenost v px), nebo None
+ def getNearestFunction(self, x, y, radius=None):
+  if radius is None:
+   radius = self.clickArea
+  return self.index.nearest(x, y, radius)
 
 
  # Tagging
@@ -1621,24 +3677,55 @@ class Plotter(OutputClass, tk.Canvas):
    else:
     self.addTag(objId, next)
  
- def tagFunction(self, lid, fid):
-  self.tagGrid(lid, next=['func', 'func-{0:d}'.format(fid)])
- 
- def tagDeadZone(self, rid):
-  self.tagGrid(rid, next='dead-zone')
- 
  # Erasing
- def eraseGrid(self):
-  self.delete('grid')
-  
  def eraseFunction(self, fid):
-  self.delete('func-{0:d}'.format(fid))
+  pool = self.funcPools.pop(fid, None)
+  if pool is not None:
+   pool.clear()
+  self.index.remove(fid)
  
  def eraseMotionLines(self):
-  self.delete('motion')
+  if self.motionShown:
+   self.itemconfigure('motion', state='hidden')
+   self.motionShown = False
    
- def eraseScrollLines(self):
-  self.delete('scroll')
+ def erasePreview(self):
+  self.delete('preview')
+ 
+ # Moving (live scroll) - everything but the cursor lines
+ def panBy(self, dx, dy):
+  self.move('grid&&!motion&&!preview', dx, dy)
+  self.index.move(dx, dy)
+  for pool in list(self.pools.values()) + list(self.funcPools.values()):
+   pool.forgetCoords()
+ 
+ # Retained scene - prvky mřížky a funkcí se při překreslení obnovují na místě (CanvasItemPool)
+ def beginGrid(self):
+  for pool in self.pools.values():
+   pool.begin()
+ 
+ def endGrid(self):
+  for pool in self.pools.values():
+   pool.end()
+  if any(pool.isGrown() for pool in self.pools.values()):
+   self.restack()
+ 
+ def beginFunction(self, fid):
+  if fid not in self.funcPools:
+   self.funcPools[fid] = CanvasItemPool(self, 'line', ('grid', 'func', 'func-{0:d}'.format(fid)))
+  self.funcPools[fid].begin()
+  self.index.remove(fid)
+ 
+ def endFunction(self, fid):
+  self.funcPools[fid].end()
+ 
+ # Nové prvky mřížky vznikají nad vším ostatním - obnoví pořadí vrstev
+ def restack(self):
+  self.tag_lower('dead-zone')
+  self.tag_lower('dead-zone-rect')
+  self.tag_raise('grid-label')
+  self.tag_raise('func')
+  self.tag_raise('motion')
  
    
  # Plot Work
@@ -1646,83 +3733,82 @@ class Plotter(OutputClass, tk.Canvas):
  def plotLine(self, *args, **kwargs):
   return self.create_line(*args, **kwargs)
 
- def plotXLine(self, yPos, colour='black'):
-  return self.plotLine(0, yPos, comp.getWVal(), yPos, fill=colour)
+ # cary presahuji platno o jeho rozmer na obe strany, aby pri zivem posunu nechybely
+ def getXLineCoords(self, yPos):
+  return (-comp.getWVal(), yPos, 2 * comp.getWVal(), yPos)
 
- def plotYLine(self, xPos, colour='black'):
-  return self.plotLine(xPos, 0, xPos, comp.getHVal(), fill=colour)
+ def getYLineCoords(self, xPos):
+  return (xPos, -comp.getHVal(), xPos, 2 * comp.getHVal())
  
- def plotXStroke(self, yPos):
-  return self.plotLine((comp.getXAxis() - comp.getStrokeLength()), yPos,
-   (comp.getXAxis() + comp.getStrokeLength() + 1), yPos, fill=conf.get('colour', 'grid-line-4'))
+ def getXStrokeCoords(self, yPos):
+  return ((comp.getXAxis() - comp.getStrokeLength()), yPos, (comp.getXAxis() + comp.getStrokeLength() + 1), yPos)
   
- def plotYStroke(self, xPos):
-  return self.plotLine(xPos, (comp.getYAxis() - comp.getStrokeLength()),
-   xPos, (comp.getYAxis() + comp.getStrokeLength() + 1), fill=conf.get('colour', 'grid-line-4'))
+ def getYStrokeCoords(self, xPos):
+  return (xPos, (comp.getYAxis() - comp.getStrokeLength()), xPos, (comp.getYAxis() + comp.getStrokeLength() + 1))
  
  # Grid lines
  def plotXGridLine(self, yPos, colour):
-  self.tagGrid(self.plotXLine(yPos, colour), add='x')
+  self.pools['grid-x'].place(self.getXLineCoords(yPos), fill=colour)
  
  def plotYGridLine(self, xPos, colour):
-  self.tagGrid(self.plotYLine(xPos, colour), add='y')
+  self.pools['grid-y'].place(self.getYLineCoords(xPos), fill=colour)
  
  def plotXGridStroke(self, yPos):
-  self.tagGrid(self.plotXStroke(yPos), add='x')
+  self.pools['stroke-x'].place(self.getXStrokeCoords(yPos), fill=self.axisColour)
  
  def plotYGridStroke(self, xPos):
-  self.tagGrid(self.plotYStroke(xPos), add='y')
+  self.pools['stroke-y'].place(self.getYStrokeCoords(xPos), fill=self.axisColour)
  
  # Scroll and Motion lines
- def plotXMotionLine(self, y):
-  self.tagGrid(self.plotXLine(y, conf.get('colour', 'grid-line-motion')), next='motion')
- 
- def plotYMotionLine(self, x):
-  self.tagGrid(self.plotYLine(x, conf.get('colour', 'grid-line-motion')), next='motion')  
-  
- def plotXScrollLine(self, y):
-  self.tagGrid(self.plotXLine(y, conf.get('colour', 'grid-line-scroll')), next='scroll')
-
- def plotYScrollLine(self, x):
-  self.tagGrid(self.plotYLine(x, conf.get('colour', 'grid-line-scroll')), next='scroll')
+ # Kříž kurzoru jsou dvě trvalé čáry, při pohybu se jen přesunou (coords)
+ def plotMotionLines(self, x, y):
+  if self.motionItems is None:
+   colour = conf.get('colour', 'grid-line-motion')
+   self.motionItems = (self.plotLine(*self.getXLineCoords(y), fill=colour, tags=('grid', 'motion')),
+    self.plotLine(*self.getYLineCoords(x), fill=colour, tags=('grid', 'motion')))
+  else:
+   self.coords(self.motionItems[0], *self.getXLineCoords(y))
+   self.coords(self.motionItems[1], *self.getYLineCoords(x))
+   if not self.motionShown:
+    self.itemconfigure('motion', state='normal')
+  self.motionShown = True
 
  # Function
  def plotFunctionLine(self, points, colour, lineWidth, fid):
-  self.tagFunction(self.plotLine(*points, fill=colour, width=lineWidth), fid)
+  self.funcPools[fid].place(points, fill=colour, width=lineWidth)
+  self.index.add(fid, points, lineWidth)
+ 
+ def restyleFunction(self, fid, colour, lineWidth):
+  if fid in self.funcPools:
+   self.funcPools[fid].restyle('func-{0:d}'.format(fid), fill=colour, width=lineWidth)
+   self.index.setWidth(fid, lineWidth)
+ 
+ def plotPreviewLine(self, points, colour, lineWidth):
+  self.tagGrid(self.plotLine(*points, fill=colour, width=lineWidth), next='preview')
    
  # Labels
- def plotLabel(self, *args, **kwargs):
-  return self.create_text(*args, **kwargs)
- 
- def plotGridLabel(self, x, y, text='0'):
-  return self.plotLabel(x + conf.get('gridpar', 'graphlabel-closer'),
-   y - conf.get('gridpar', 'graphlabel-closer'), text=text, anchor=conf.get('gridpar', 'graphlabel-anchor'))
+ def getLabelCoords(self, x, y):
+  return (x + self.labelCloser, y - self.labelCloser)
  
  # Grid Labels
  def plotXGridLabel(self, x, text):
-  self.tagGrid(self.plotGridLabel(x=x, y=comp.getYAxis(), text=text), add='label-x')
+  self.pools['label-x'].place(self.getLabelCoords(x, comp.getYAxis()), text=text, anchor=self.labelAnchor)
  
  def plotYGridLabel(self, y, text): 
-  self.tagGrid(self.plotGridLabel(x=comp.getXAxis(), y=y, text=text), add='label-y')
+  self.pools['label-y'].place(self.getLabelCoords(comp.getXAxis(), y), text=text, anchor=self.labelAnchor)
 
  # Dead Zones
- def plotRect(self, *args, **kwargs):
-  return self.create_rectangle(*args, **kwargs)
-  
  def plotHDeadZoneRect(self, y1, y2):
-  self.tagDeadZone(self.plotRect(0, y1, comp.getWVal(), y2, fill=conf.get('colour', 'dead-zone'), width=0))
+  self.pools['dead-zone-rect'].place((0, y1, comp.getWVal(), y2), fill=self.deadZoneColour, width=0)
  
  def plotWDeadZoneRect(self, x1, x2):
-  self.tagDeadZone(self.plotRect(x1, 0, x2, comp.getHVal(), fill=conf.get('colour', 'dead-zone'), width=0))
+  self.pools['dead-zone-rect'].place((x1, 0, x2, comp.getHVal()), fill=self.deadZoneColour, width=0)
  
  def plotHDeadZoneLine(self):
-  self.tagDeadZone(self.plotXLine(comp.getYAxis(), conf.get('colour', 'grid-line-4')))
+  self.pools['dead-zone-line'].place(self.getXLineCoords(comp.getYAxis()), fill=self.axisColour)
 
  def plotWDeadZoneLine(self):
-  self.tagDeadZone(self.plotYLine(comp.getXAxis(), conf.get('colour', 'grid-line-4')))
- 
- def plotZeroLabel(self):
-  self.tagDeadZone(self.plotGridLabel(x=comp.getXAxis(), y=comp.getYAxis(), text='0'))
+  self.pools['dead-zone-line'].place(self.getYLineCoords(comp.getXAxis()), fill=self.axisColour)
  
  # Gettery jádra
  def getCanvasWidth(self):
@@ -1772,6 +3858,9 @@ class ControlPanel(Panel):
  def motionEnd(self):
   self.motionPanel.motionEnd()
 
+ def hover(self, *args, **kwargs):
+  self.motionPanel.hover(*args, **kwargs)
+
  def scrollStart(self, *args, **kwargs):
   self.motionPanel.scrollStart(*args, **kwargs)
 
@@ -2165,6 +4254,17 @@ class MotionPanel(Panel):
   self.xLabel.config(text='')
   self.yLabel.config(text='')
  
+ # Hodnota funkce pod kurzorem (barvou funkce), fid None maže
+ def hover(self, fid, value):
+  if fid is None:
+   self.fLabel.config(text='')
+  else:
+   if value is None:
+    text = conf.get('out', 'hover-undefined')
+   else:
+    text = conf.get('out', 'position-format').format(float(value))
+   self.fLabel.config(text=('f(x): ' + text), foreground=fman.getFunction(fid).getColour())
+ 
  def scrollStart(self, x, y):
   self.scrollBegin = (x, y)
   self.scrollModify(x, y)
@@ -2194,13 +4294,17 @@ class MotionPanel(Panel):
  def switchLines(self):
   mgr.switchMotionLines()
 
+ def switchHover(self):
+  mgr.switchHover()
 
  def build(self):
   self.frame = tk.LabelFrame(self, text=conf.get('out', 'motion-header'))
   self.linesCheck = tk.Checkbutton(self.frame, text=conf.get('out', 'motion-lines-checker'), command=self.switchLines)
+  self.hoverCheck = tk.Checkbutton(self.frame, text=conf.get('out', 'motion-hover-checker'), command=self.switchHover)
   self.posPanel = tk.Frame(self.frame)
   self.xLabel = tk.Label(self.posPanel, text='')
   self.yLabel = tk.Label(self.posPanel, text='')
+  self.fLabel = tk.Label(self.posPanel, text='')
   self.footerPanel = tk.Frame(self.frame)
   # defined scroll buttons
   self.centerButton = tk.Button(self.footerPanel, image=win.centerImg, command=self.scrollCenter)
@@ -2212,9 +4316,11 @@ class MotionPanel(Panel):
   self.pack(side='left', fill='both', expand=1, padx=4)
   self.frame.pack(side='top', pady=2)
   self.linesCheck.pack(side='top')
+  self.hoverCheck.pack(side='top')
   self.posPanel.pack(side='top', fill='both', expand=1)
   self.xLabel.pack(side='top', pady=2)
   self.yLabel.pack(side='top', pady=2)
+  self.fLabel.pack(side='top', pady=2)
   self.footerPanel.pack(side='bottom', fill='x', expand=1, padx=5)
   self.centerButton.pack(side='right')
   self.bottomButton.pack(side='right')
@@ -2557,21 +4663,22 @@ class MenuCommand(OutputClass):
 
  
 
-# class StatusBar(OutputClass, tk.Label):
-#  def __init__(self, master, defText=''):
-#   self.default = str(defText)
-#   self.current = str(defText)
-#   tk.Label.__init__(self, master, text=self.default)
-#  
-#  def change(self, text=''):
-#   self.current = text
-#   self.config(text=self.current)
-#  
-#  def rollback(self):
-#   self.config(text=self.default)
-#  
-#  def display(self):
-#   self.pack(side='left')
+class StatusBar(OutputClass, tk.Label):
+ def __init__(self, master, defText=''):
+  self.default = str(defText)
+  self.current = str(defText)
+  tk.Label.__init__(self, master, text=self.default)
+ 
+ def change(self, text=''):
+  if text != self.current:
+   self.current = text
+   self.config(text=self.current)
+ 
+ def rollback(self):
+  self.change(self.default)
+ 
+ def display(self):
+  self.pack(side='left')
  
 class SupportClass(BaseClass):
  pass
@@ -2644,25 +4751,28 @@ class DataOperator(FileWorkClass):
   return os.path.join(conf.get('path', 'data'), self.fileName + '.' + DATAF_EXT)
 
 
+# Čte soubor proudově (iterparse) - každá funkce se zpracuje, jakmile je načtená, a hned se
+# uvolní, takže ani dokument s mnoha funkcemi se nedrží v paměti celý.
 class Importer(DataOperator):
+ GRID_TAGS = ('wfactor', 'hfactor', 'xscale', 'yscale', 'xpiquot')
+ 
  def load(self):
-  self.data = ioc.XMLReader(self.filePath)
-  root = self.data.getRoot()
-  gridData = self.data.child(root, 'gridinfo')
-  self.wFactor = float(self.data.childContent(gridData, 'wfactor'))
-  self.hFactor = float(self.data.childContent(gridData, 'hfactor'))
-  self.xScale = float(self.data.childContent(gridData, 'xscale'))
-  self.yScale = float(self.data.childContent(gridData, 'yscale'))
-  if self.data.child(gridData, 'xpiquot'):
-   self.xPiQuot = int(self.data.childContent(gridData, 'xpiquot'))
-  else:
-   self.xPiQuot = 0
-  funcData = self.data.child(root, 'funcinfo')
-  funcList = self.data.children(funcData, 'function')
+  gridValues = {}
   self.functions = {}
-  for funcEl in funcList:
-   self.functions[int(self.data.attribute(funcEl, 'id'))] = (int(self.data.attribute(funcEl, 'ord')),
-     self.data.childContent(funcEl, 'exprsrc'), self.data.childContent(funcEl, 'exprfin'))
+  for event, element in etree.iterparse(self.filePath, events=('end',)):
+   if element.tag == 'function':
+    self.functions[int(element.get('id'))] = (int(element.get('ord')),
+     element.findtext('exprsrc', '').strip(), element.findtext('exprfin', '').strip())
+    element.clear()
+   elif element.tag in Importer.GRID_TAGS and (element.text or '').strip():
+    gridValues[element.tag] = element.text.strip()
+  # chybějící nebo prázdný údaj - osy uprostřed, výchozí měřítko, bez pí
+  defaultScale = conf.get('gridpar', 'default-scale')
+  self.wFactor = float(gridValues.get('wfactor', 0.5))
+  self.hFactor = float(gridValues.get('hfactor', 0.5))
+  self.xScale = float(gridValues.get('xscale', defaultScale))
+  self.yScale = float(gridValues.get('yscale', defaultScale))
+  self.xPiQuot = int(gridValues.get('xpiquot', 0))
  
  def getWFactor(self):
   return self.wFactor